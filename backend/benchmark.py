@@ -0,0 +1,197 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from psycopg_pool import ConnectionPool
+from .config import DB_URL
+from .ingest import PowerReadingWriter
+from .mqtt_class import MQTTClass, BrokerConnection
+from .broadcast import hub
+from .scheduler import ChargingScheduler
+from .simulator import SimulatedPlug, Simulator
+
+
+BENCH_PREFIX = "bench"
+BENCH_SCHEMA = "benchmark" # scratch copies of the power tables written by the ingest benchmark
+POWER_TABLES = ("power_readings", "power_rollup_2m", "power_rollup_1h")
+
+
+def summary(name:str, values_ms):
+    values_ms = np.asarray(values_ms, dtype=np.float64)
+    if len(values_ms) == 0:
+        print(f"{name}: no samples")
+        return float("inf")
+    p50, p95, p99 = np.percentile(values_ms, [50, 95, 99])
+    print(f"{name}: n={len(values_ms)} p50={p50:.2f} ms p95={p95:.2f} ms p99={p99:.2f} ms max={values_ms.max():.2f} ms")
+    return p95
+
+
+def scratch_pool() -> ConnectionPool:
+    # Connections that resolve the unqualified power tables to empty copies (indexes and constraints included)
+    # in BENCH_SCHEMA, so the ingest benchmark runs the real COPY and rollup statements without ever touching
+    # the live tables. A copy left behind by an interrupted run is replaced.
+    scratch = ConnectionPool(DB_URL, min_size=1, max_size=1, kwargs={"options": f"-c search_path={BENCH_SCHEMA},public"}, open=True)
+    with scratch.connection() as conn:
+        conn.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        conn.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+        for table in POWER_TABLES:
+            conn.execute(f"CREATE TABLE {BENCH_SCHEMA}.{table} (LIKE {table} INCLUDING ALL)")
+    return scratch
+
+
+def drop_scratch(scratch:ConnectionPool):
+    try:
+        with scratch.connection() as conn:
+            conn.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+    except Exception as err:
+        print(f"Could not drop the benchmark schema {BENCH_SCHEMA}: {err}")
+    scratch.close()
+
+
+def bench_ingest(readings:int, devices:int, batch_size:int):
+    # end-to-end write rate of the ingest stage: queue, COPY and rollup maintenance
+    scratch = scratch_pool()
+    try:
+        writer = PowerReadingWriter(batch_size=batch_size, flush_interval=1.0, max_queue=readings + 1, put_timeout=5.0, db_pool=scratch)
+        start_ts = datetime.now(timezone.utc) - timedelta(seconds=readings // devices)
+
+        started = time.perf_counter()
+        for i in range(readings):
+            writer.put(f"{BENCH_PREFIX}-{i % devices}", 1000.0 + i % 50, start_ts + timedelta(seconds=i // devices))
+        enqueued = time.perf_counter()
+        writer.flush(timeout=600)
+        finished = time.perf_counter()
+    finally:
+        drop_scratch(scratch)
+
+    rate = readings / (finished - started)
+    print(f"ingest: {readings} readings from {devices} devices, enqueue {readings / (enqueued - started):.0f}/s, written {rate:.0f}/s")
+    return rate
+
+
+class LatencySocket():
+    # stands in for a dashboard WebSocket and records MQTT publish -> WebSocket send latency
+    def __init__(self, plug:SimulatedPlug):
+        self.plug = plug
+        self.latencies = []
+
+    async def send_text(self, text:str):
+        sent = self.plug.sent.pop(json.loads(text)["power"], None)
+        if sent is not None:
+            self.latencies.append((time.perf_counter() - sent) * 1000)
+
+
+async def bench_latency(broker:str, port:int, devices:int, rate:float, duration:float):
+    loop = asyncio.get_running_loop()
+    plugs = [SimulatedPlug(f"{BENCH_PREFIX}-{i}", profile="sequence") for i in range(devices)]
+    for plug in plugs:
+        plug.output = True
+
+    connection = BrokerConnection(broker, port, loop)
+    sockets = []
+    for plug in plugs:
+        connection.add_device(MQTTClass(
+            device_id=plug.device_id, broker=broker, port=port, loop=loop, client=connection.client, store_readings=False
+        ))
+        sockets.append(LatencySocket(plug))
+        hub.subscribe(plug.device_id, sockets[-1])
+    connection.connect()
+    await asyncio.sleep(1) # let the subscriptions settle
+
+    simulator = Simulator(plugs, broker, port, rate)
+    simulator.start()
+    await asyncio.sleep(duration)
+    await asyncio.to_thread(simulator.stop)
+    await asyncio.sleep(0.5)
+    connection.close()
+
+    latencies = [latency for socket in sockets for latency in socket.latencies]
+    print(f"mqtt: {simulator.published / duration:.0f} messages/s published by {devices} simulated plugs")
+    return summary("mqtt -> websocket latency", latencies)
+
+
+class TimingController():
+    def __init__(self, device_id:str):
+        self.device_id = device_id
+        self.switched = []
+
+    async def switch(self, state:bool):
+        self.switched.append(time.time())
+
+
+async def bench_scheduler(sessions:int, transitions:int, spacing:float):
+    # how late switch transitions fire when many sessions share the scheduler
+    scheduler = ChargingScheduler(record_readings=False)
+    now = datetime.now(timezone.utc)
+    controllers, expected = [], []
+
+    for i in range(sessions):
+        controller = TimingController(f"{BENCH_PREFIX}-{i}")
+        offset = 0.5 + (i % 10) * spacing / 10
+        edges = [now + timedelta(seconds=offset + k * spacing) for k in range(transitions * 2)]
+        intervals = list(zip(edges[0::2], edges[1::2]))
+        end_date = edges[-1] + timedelta(seconds=spacing)
+        scheduler.schedule(controller, intervals, end_date)
+        controllers.append(controller)
+        # the first switch is the initial state, applied immediately
+        expected.append([now.timestamp()] + [edge.timestamp() for edge in edges] + [end_date.timestamp()])
+
+    await asyncio.gather(*[plan.done for plan in list(scheduler.plans.values())], return_exceptions=True)
+
+    lateness = [
+        (actual - planned) * 1000
+        for controller, planned_times in zip(controllers, expected)
+        for actual, planned in list(zip(controller.switched, planned_times))[1:]
+    ]
+    return summary(f"scheduler lateness ({sessions} sessions)", lateness)
+
+
+async def run(args):
+    failures = []
+
+    if not args.skip_db:
+        rate = await asyncio.to_thread(bench_ingest, args.readings, args.devices, args.batch_size)
+        if args.min_ingest_rate and rate < args.min_ingest_rate:
+            failures.append(f"ingest rate {rate:.0f}/s below {args.min_ingest_rate}/s")
+
+    if not args.skip_mqtt:
+        p95 = await bench_latency(args.broker, args.port, args.devices, args.rate, args.duration)
+        if args.max_latency_ms and p95 > args.max_latency_ms:
+            failures.append(f"p95 mqtt -> websocket latency {p95:.1f} ms above {args.max_latency_ms} ms")
+
+    p95 = await bench_scheduler(args.sessions, args.transitions, args.spacing)
+    if args.max_lateness_ms and p95 > args.max_lateness_ms:
+        failures.append(f"p95 scheduler lateness {p95:.1f} ms above {args.max_lateness_ms} ms")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the ingest, MQTT -> WebSocket and scheduling hot paths")
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=10.0, help="events per second and simulated plug")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of simulated MQTT traffic")
+    parser.add_argument("--readings", type=int, default=100000, help="readings written by the ingest benchmark")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--sessions", type=int, default=500)
+    parser.add_argument("--transitions", type=int, default=3, help="on/off pairs per benchmarked session")
+    parser.add_argument("--spacing", type=float, default=0.5, help="seconds between benchmarked transitions")
+    parser.add_argument("--skip-db", action="store_true")
+    parser.add_argument("--skip-mqtt", action="store_true")
+    parser.add_argument("--min-ingest-rate", type=float, default=None, help="fail below this many readings/s")
+    parser.add_argument("--max-latency-ms", type=float, default=None, help="fail above this p95 MQTT -> WebSocket latency")
+    parser.add_argument("--max-lateness-ms", type=float, default=None, help="fail above this p95 scheduler lateness")
+    args = parser.parse_args()
+
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import asyncio
+import json
+import time
+from .config import WS_QUEUE_SIZE, WS_SEND_TIMEOUT, WS_SLOW_CLIENT_POLICY
+from .metrics import registry, WS_SEND_SECONDS, WS_DROPPED
+
+
+class Subscriber():
+    def __init__(self, ws, device_id:str, queue_size:int, backfill=()):
+        self.ws = ws
+        self.device_id = device_id
+        self.backfill = list(backfill) # history sent before the first live message
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.task = None
+        self.dropped = 0
+
+
+class BroadcastHub():
+    # Per-device channels of WebSocket subscribers. Every subscriber has its own bounded queue and sender task,
+    # so a slow or dead dashboard only ever delays itself. When a queue is full the oldest pending message is
+    # dropped ("drop_oldest"), or with "latest" only the newest message is kept.
+    def __init__(self, queue_size:int=32, send_timeout:float=5.0, policy:str="drop_oldest"):
+        self.queue_size = 1 if policy == "latest" else queue_size
+        self.send_timeout = send_timeout
+        self.channels = {}
+
+    def subscribe(self, device_id:str, ws, backfill=()) -> Subscriber:
+        subscriber = Subscriber(ws, device_id, self.queue_size, backfill)
+        self.channels.setdefault(device_id, set()).add(subscriber)
+        subscriber.task = asyncio.create_task(self._send_loop(subscriber))
+        return subscriber
+
+    def unsubscribe(self, subscriber:Subscriber):
+        channel = self.channels.get(subscriber.device_id)
+        if channel is not None:
+            channel.discard(subscriber)
+            if not channel:
+                del self.channels[subscriber.device_id]
+        if subscriber.task is not None and subscriber.task is not asyncio.current_task():
+            subscriber.task.cancel()
+
+    def publish(self, device_id:str, message:dict):
+        channel = self.channels.get(device_id)
+        if not channel:
+            return
+        text = json.dumps(message) # serialised once for every subscriber
+        for subscriber in list(channel):
+            self._offer(subscriber, text)
+
+    def publish_threadsafe(self, loop, device_id:str, message:dict):
+        # called from the paho network thread, hands the message to the event loop without waiting for delivery
+        loop.call_soon_threadsafe(self.publish, device_id, message)
+
+    def _offer(self, subscriber:Subscriber, text:str):
+        if subscriber.queue.full():
+            subscriber.queue.get_nowait()
+            subscriber.dropped += 1
+            WS_DROPPED.inc(subscriber.device_id)
+        subscriber.queue.put_nowait(text)
+
+    async def _send_loop(self, subscriber:Subscriber):
+        try:
+            for message in subscriber.backfill:
+                await asyncio.wait_for(subscriber.ws.send_text(json.dumps(message)), self.send_timeout)
+            subscriber.backfill = None
+            while True:
+                text = await subscriber.queue.get()
+                started = time.perf_counter()
+                await asyncio.wait_for(subscriber.ws.send_text(text), self.send_timeout)
+                WS_SEND_SECONDS.observe(time.perf_counter() - started)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            print(f"Dropping WebSocket subscriber of {subscriber.device_id}: {err!r}")
+            self.unsubscribe(subscriber)
+
+    def queue_depths(self) -> dict:
+        # pending messages per device, summed over its subscribers
+        return {
+            (device_id,): sum(subscriber.queue.qsize() for subscriber in list(channel))
+            for device_id, channel in list(self.channels.items())
+        }
+
+    def subscriber_counts(self) -> dict:
+        return {(device_id,): len(channel) for device_id, channel in list(self.channels.items())}
+
+
+hub = BroadcastHub(queue_size=WS_QUEUE_SIZE, send_timeout=WS_SEND_TIMEOUT, policy=WS_SLOW_CLIENT_POLICY)
+
+registry.gauge("ws_queue_depth", "Messages waiting in WebSocket subscriber queues", ("device_id",), callback=hub.queue_depths)
+registry.gauge("ws_subscribers", "Connected WebSocket subscribers", ("device_id",), callback=hub.subscriber_counts)
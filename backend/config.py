@@ -6,14 +6,70 @@ load_dotenv()  # reads .env
 MQTT_SERVER = os.getenv("MQTT_SERVER")
 MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
 SHELLY_ID = os.getenv("SHELLY_ID")
+SHELLY_IDS = [device_id.strip() for device_id in os.getenv("SHELLY_IDS", SHELLY_ID or "").split(",") if device_id.strip()]
 
 ENTSOE_API_KEY = os.getenv("ENTSOE_API_KEY")
 ESIOS_API_KEY = os.getenv("ESIOS_API_KEY")
+PRICE_SOURCE = os.getenv("PRICE_SOURCE", "esios") # esios, entsoe:<area> or file:<path>
+# per device overrides, e.g. "shelly-a=entsoe:DE_LU,shelly-b=file:/data/prices.parquet"
+DEVICE_PRICE_SOURCES = dict(
+    item.strip().split("=", 1) for item in os.getenv("DEVICE_PRICE_SOURCES", "").split(",") if "=" in item
+)
 
 DB_URL = os.getenv("DB_URL")
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 1)) # sync pool: ingest writer and maintenance threads
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 4))
+DB_ASYNC_POOL_MIN_SIZE = int(os.getenv("DB_ASYNC_POOL_MIN_SIZE", 2)) # async pool: request handlers and sessions
+DB_ASYNC_POOL_MAX_SIZE = int(os.getenv("DB_ASYNC_POOL_MAX_SIZE", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30.0))
 
 APP_USERNAME = os.getenv("APP_USERNAME")
 APP_PASSWORD = os.getenv("APP_PASSWORD")
 
 JWT_SECRET = os.getenv("JWT_SECRET")
 
+
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 500))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", 2.0))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 10000))
+INGEST_PUT_TIMEOUT = float(os.getenv("INGEST_PUT_TIMEOUT", 1.0))
+
+SWITCH_ACK_TIMEOUT = float(os.getenv("SWITCH_ACK_TIMEOUT", 2.0)) # wait for the first attempt, doubled on every retry
+SWITCH_RETRIES = int(os.getenv("SWITCH_RETRIES", 3))
+
+MQTT_ONLINE_TIMEOUT = float(os.getenv("MQTT_ONLINE_TIMEOUT", 5.0))
+MQTT_RECONNECT_MAX_DELAY = int(os.getenv("MQTT_RECONNECT_MAX_DELAY", 60))
+
+TELEMETRY_FILTER = os.getenv("TELEMETRY_FILTER", "off") # off, deadband or swinging_door
+TELEMETRY_DEADBAND_W = float(os.getenv("TELEMETRY_DEADBAND_W", 5.0))
+TELEMETRY_COMPRESSION_W = float(os.getenv("TELEMETRY_COMPRESSION_W", 10.0))
+TELEMETRY_MAX_SILENCE = float(os.getenv("TELEMETRY_MAX_SILENCE", 60.0)) # heartbeat: publish at least this often
+
+PRICE_CACHE_SIZE = int(os.getenv("PRICE_CACHE_SIZE", 200000))
+PRICE_MISSING_TTL = float(os.getenv("PRICE_MISSING_TTL", 900))
+
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 10.0))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 3))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", 0.5))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 10))
+
+BATTERY_CAPACITY_KWH = float(os.getenv("BATTERY_CAPACITY_KWH", 8.0))
+CHARGER_POWER_KW = float(os.getenv("CHARGER_POWER_KW", 2.0)) # 8 kWh at 2 kW keeps the original 4 hours from 0 to 100%
+MIN_RUN_SLOTS = int(os.getenv("MIN_RUN_SLOTS", 2))
+FORECAST_HISTORY_DAYS = int(os.getenv("FORECAST_HISTORY_DAYS", 28)) # price history the forecast is fitted on, 0 disables it
+FORECAST_RIDGE_ALPHA = float(os.getenv("FORECAST_RIDGE_ALPHA", 1.0))
+REPLAN_INTERVAL_MINUTES = float(os.getenv("REPLAN_INTERVAL_MINUTES", 10)) # how often active sessions look for newly published prices
+
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", 2))
+RAW_RETENTION_DAYS = int(os.getenv("RAW_RETENTION_DAYS", 90))
+ROLLUP_2M_RETENTION_DAYS = int(os.getenv("ROLLUP_2M_RETENTION_DAYS", 730))
+MAINTENANCE_INTERVAL_HOURS = float(os.getenv("MAINTENANCE_INTERVAL_HOURS", 6))
+
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", 32))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", 5.0))
+WS_SLOW_CLIENT_POLICY = os.getenv("WS_SLOW_CLIENT_POLICY", "drop_oldest") # or "latest"
+WS_BACKFILL_SECONDS = int(os.getenv("WS_BACKFILL_SECONDS", 900)) # history sent to a new /ws/power subscriber
+
+RECENT_READINGS_SIZE = int(os.getenv("RECENT_READINGS_SIZE", 100000)) # readings kept in memory per device
+
+DEFAULT_CHART_POINTS = int(os.getenv("DEFAULT_CHART_POINTS", 1000))
@@ -0,0 +1,225 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+import numpy as np
+import pandas as pd
+from .db import async_pool
+from .metrics import async_pooled_connection
+from .price_providers import provider_for
+from .price_forecast import hourly_series
+from .utils import pick_up_datetime
+from .config import SHELLY_ID
+
+
+GRANULARITIES = ("day", "week", "month", "session")
+
+HOURLY_ENERGY_SQL = """
+    SELECT extract(epoch FROM bucket)::bigint, SUM(energy_wh)
+    FROM power_rollup_1h
+    WHERE bucket >= %(start)s AND bucket < %(end)s
+        AND (%(device_id)s::text IS NULL OR device_id = %(device_id)s::text)
+    GROUP BY bucket
+    ORDER BY bucket
+"""
+
+SLOT_ENERGY_SQL = """
+    SELECT extract(epoch FROM bucket)::bigint, device_id, energy_wh
+    FROM power_rollup_2m
+    WHERE bucket >= %(start)s AND bucket < %(end)s
+        AND (%(device_id)s::text IS NULL OR device_id = %(device_id)s::text)
+    ORDER BY bucket
+"""
+
+# sessions saved by /api/save_session have no device, they belong to the default plug. The charging session
+# started at the same time is preferred over such a row, and superseded or cancelled plans are left out.
+SESSIONS_SQL = """
+    SELECT start_charge_timestamp, pick_up_hour, pick_up_minute, device
+    FROM (
+        SELECT DISTINCT ON (start_charge_timestamp, COALESCE(device_id, %(default_device)s::text))
+            start_charge_timestamp, pick_up_hour, pick_up_minute, status,
+            COALESCE(device_id, %(default_device)s::text) AS device
+        FROM sessions
+        WHERE start_charge_timestamp >= %(start)s - interval '1 day' AND start_charge_timestamp < %(end)s
+        ORDER BY start_charge_timestamp, COALESCE(device_id, %(default_device)s::text), device_id NULLS LAST
+    ) latest
+    WHERE (status IS NULL OR status NOT IN ('superseded', 'cancelled'))
+        AND (%(device_id)s::text IS NULL OR device = %(device_id)s::text)
+    ORDER BY start_charge_timestamp
+"""
+
+
+def local_day_range(start_dt:str, end_dt:str, tz:str="Europe/Madrid"):
+    # 'YYYY-MM-DD' local dates (end included) to a half-open UTC range
+    local_tz = ZoneInfo(tz)
+    start = datetime.strptime(start_dt, "%Y-%m-%d").replace(tzinfo=local_tz)
+    end = datetime.strptime(end_dt, "%Y-%m-%d").replace(tzinfo=local_tz) + timedelta(days=1)
+    return start.astimezone(timezone.utc), end.astimezone(timezone.utc)
+
+
+async def fetch_hourly_energy(start:datetime, end:datetime, device_id=None):
+    async with async_pooled_connection(async_pool, "cost_engine") as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(HOURLY_ENERGY_SQL, {"start": start, "end": end, "device_id": device_id}, prepare=True)
+            rows = await cur.fetchall()
+
+    epochs = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    energy_wh = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+    return epochs, energy_wh
+
+
+async def fetch_slot_energy(start:datetime, end:datetime, device_id=None):
+    # 2 minute energy per device, so sessions starting mid hour are not rounded to the hour
+    async with async_pooled_connection(async_pool, "cost_engine") as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(SLOT_ENERGY_SQL, {"start": start, "end": end, "device_id": device_id}, prepare=True)
+            rows = await cur.fetchall()
+
+    epochs = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    devices = np.array([row[1] for row in rows], dtype=object)
+    energy_wh = np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows))
+    return epochs, devices, energy_wh
+
+
+async def fetch_session_windows(start:datetime, end:datetime, device_id=None):
+    # (start, end, device) of the sessions overlapping the range, ordered by start
+    params = {"start": start, "end": end, "device_id": device_id, "default_device": SHELLY_ID}
+    async with async_pooled_connection(async_pool, "cost_engine") as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(SESSIONS_SQL, params, prepare=True)
+            rows = await cur.fetchall()
+
+    spain_tz = ZoneInfo("Europe/Madrid")
+    starts = np.empty(len(rows), dtype=np.int64)
+    ends = np.empty(len(rows), dtype=np.int64)
+    devices = np.array([row[3] for row in rows], dtype=object)
+    for i, (session_start, hour, minute, _) in enumerate(rows):
+        session_start = session_start.astimezone(spain_tz)
+        starts[i] = int(session_start.timestamp())
+        ends[i] = int(pick_up_datetime(session_start, hour, minute).timestamp())
+    return starts, ends, devices
+
+
+def hour_prices(energy_epochs, price_epochs, prices):
+    # price of the hour every energy epoch falls in, NaN where the hour has none
+    if len(energy_epochs) == 0 or len(price_epochs) == 0:
+        return np.full(len(energy_epochs), np.nan)
+
+    base = min(energy_epochs.min(), price_epochs.min()) // 3600
+    span = max(energy_epochs.max(), price_epochs.max()) // 3600 - base + 1
+
+    price_by_hour = np.full(span, np.nan)
+    price_by_hour[price_epochs // 3600 - base] = prices
+    return price_by_hour[energy_epochs // 3600 - base]
+
+
+def hourly_costs(energy_epochs, energy_wh, price_epochs, prices):
+    # aligns energy and prices by integer hour index; hours without a price are left out
+    energy_prices = hour_prices(energy_epochs, price_epochs, prices)
+    priced = ~np.isnan(energy_prices)
+    cost = energy_wh[priced] / 1e6 * energy_prices[priced] # Wh -> MWh times EUR/MWh
+
+    return energy_epochs[priced], energy_wh[priced], cost
+
+
+def group_keys(epochs, granularity:str, tz:str="Europe/Madrid"):
+    # local calendar period start of every hour, as datetime64[D] (day, week starting Monday) or datetime64[M] (month)
+    local = pd.to_datetime(epochs, unit="s", utc=True).tz_convert(tz).tz_localize(None).values
+    days = local.astype("datetime64[D]")
+    if granularity == "day":
+        return days
+    if granularity == "week":
+        return days - ((days.astype(np.int64) + 3) % 7).astype("timedelta64[D]") # 1970-01-01 was a Thursday
+    return local.astype("datetime64[M]")
+
+
+def session_index(epochs, devices, starts, ends, session_devices):
+    # index of the session every energy epoch belongs to (the latest one of its device started before it), -1 for none
+    idx = np.full(len(epochs), -1, dtype=np.int64)
+    for device in set(session_devices):
+        sessions = np.flatnonzero(session_devices == device)
+        rows = np.flatnonzero(devices == device)
+        i = np.searchsorted(starts[sessions], epochs[rows], side="right") - 1
+        inside = (i >= 0) & (epochs[rows] < ends[sessions[np.maximum(i, 0)]])
+        idx[rows[inside]] = sessions[i[inside]]
+    return idx
+
+
+def aggregate_costs(epochs, energy_wh, cost, granularity:str="month", session_windows=None, devices=None):
+    # devices: device of every epoch, only needed for the session granularity
+    if granularity == "session":
+        starts, ends, session_devices = session_windows
+        if len(starts) == 0:
+            return []
+        idx = session_index(epochs, devices, starts, ends, session_devices)
+        inside = idx >= 0
+        keys, inverse = np.unique(idx[inside], return_inverse=True)
+        totals = np.bincount(inverse, weights=cost[inside], minlength=len(keys))
+        energy = np.bincount(inverse, weights=energy_wh[inside], minlength=len(keys))
+        return [
+            {
+                "session_start": datetime.fromtimestamp(starts[key], timezone.utc).isoformat(),
+                "session_end": datetime.fromtimestamp(ends[key], timezone.utc).isoformat(),
+                "device_id": session_devices[key],
+                "energy_wh": float(e),
+                "total_cost": float(c),
+            }
+            for key, e, c in zip(keys, energy, totals)
+        ]
+
+    keys, inverse = np.unique(group_keys(epochs, granularity), return_inverse=True)
+    totals = np.bincount(inverse, weights=cost, minlength=len(keys))
+    energy = np.bincount(inverse, weights=energy_wh, minlength=len(keys))
+
+    if granularity == "month":
+        months = keys.astype(np.int64)
+        return [
+            {"year": int(m // 12 + 1970), "month": int(m % 12 + 1), "energy_wh": float(e), "total_cost": float(c)}
+            for m, e, c in zip(months, energy, totals)
+        ]
+
+    return [
+        {"period": str(key), "energy_wh": float(e), "total_cost": float(c)}
+        for key, e, c in zip(keys, energy, totals)
+    ]
+
+
+def price_arrays(price_rows):
+    # (hour epochs, mean price of every hour), NaN for hours without one; quarter hour markets are averaged
+    first, prices = hourly_series(price_rows)
+    return first + np.arange(len(prices), dtype=np.int64) * 3600, prices
+
+
+async def device_hour_prices(epochs, devices, start:datetime, end:datetime):
+    # price of every epoch on the market of its own device, each market fetched once
+    providers = {device: provider_for(device) for device in set(devices)}
+    markets = {provider.key: provider for provider in providers.values()}
+    rows = await asyncio.gather(*(provider.get_range(start, end) for provider in markets.values()))
+    market_prices = {key: price_arrays(price_rows) for key, price_rows in zip(markets, rows)}
+
+    energy_prices = np.full(len(epochs), np.nan)
+    for device, provider in providers.items():
+        rows = devices == device
+        energy_prices[rows] = hour_prices(epochs[rows], *market_prices[provider.key])
+    return energy_prices
+
+
+async def historic_costs(start_dt:str, end_dt:str, granularity:str="month", device_id=None):
+    # priced on the market of the device, or of PRICE_SOURCE for every device together
+    start, end = local_day_range(start_dt, end_dt)
+
+    if granularity == "session":
+        (epochs, devices, energy_wh), session_windows = await asyncio.gather(
+            fetch_slot_energy(start, end, device_id),
+            fetch_session_windows(start, end, device_id)
+        )
+        energy_prices = await device_hour_prices(epochs, devices, start, end)
+        priced = ~np.isnan(energy_prices)
+        cost = energy_wh[priced] / 1e6 * energy_prices[priced] # Wh -> MWh times EUR/MWh
+        return aggregate_costs(epochs[priced], energy_wh[priced], cost, granularity, session_windows, devices[priced])
+
+    price_rows, (energy_epochs, energy_wh) = await asyncio.gather(
+        provider_for(device_id).get_range(start, end),
+        fetch_hourly_energy(start, end, device_id)
+    )
+    epochs, energy_wh, cost = hourly_costs(energy_epochs, energy_wh, *price_arrays(price_rows))
+    return aggregate_costs(epochs, energy_wh, cost, granularity)
@@ -0,0 +1,59 @@
+import numpy as np
+
+
+def time_buckets(x, n_buckets:int):
+    # equal-width time buckets ("pixels") over the span of x
+    span = x[-1] - x[0]
+    if span <= 0:
+        return np.zeros(len(x), dtype=np.int64)
+    return np.minimum(((x - x[0]) * n_buckets / span).astype(np.int64), n_buckets - 1)
+
+
+def minmax(x, y, points:int):
+    # keeps the minimum and maximum of every time bucket (points/2 buckets), so spikes survive downsampling
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    if len(x) <= points:
+        return np.arange(len(x))
+
+    buckets = time_buckets(x, max(points // 2, 1))
+    order = np.lexsort((y, buckets))
+    starts = np.flatnonzero(np.r_[True, np.diff(buckets[order]) != 0])
+    ends = np.r_[starts[1:], len(order)] - 1
+
+    return np.unique(np.concatenate([order[starts], order[ends]]))
+
+
+def lttb(x, y, points:int):
+    # Largest-Triangle-Three-Buckets: keeps the point of each bucket forming the largest triangle with the
+    # previously kept point and the average of the next bucket. Returns the indices of the kept points.
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    n = len(x)
+    if points >= n:
+        return np.arange(n)
+    if points < 3:
+        return np.array([0, n - 1])[:max(points, 1)]
+
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    selected = np.empty(points, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+
+    a = 0
+    for i in range(points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_lo, next_hi = hi, (edges[i + 2] if i + 2 < len(edges) else n)
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+
+    return selected
+
+
+METHODS = {"lttb": lttb, "minmax": minmax}
+
+
+def downsample(x, y, points:int, method:str="lttb"):
+    idx = METHODS[method](x, y, points)
+    return np.asarray(x)[idx], np.asarray(y)[idx]
@@ -0,0 +1,87 @@
+import io
+import xml.etree.ElementTree as ET
+import numpy as np
+
+
+SLOT = np.timedelta64(15, "m")
+RESOLUTION_SLOTS = {"PT15M": 1, "PT30M": 2, "PT60M": 4}
+
+
+def local_tag(elem):
+    return elem.tag.rsplit("}", 1)[-1]
+
+
+def to_datetime64(text):
+    # ENTSO-E writes UTC times as 2026-01-01T23:00Z
+    return np.datetime64(text.strip().rstrip("Z"), "m")
+
+
+def forward_fill(values, known):
+    # replaces every unknown slot with the last known value before it (NaN if there is none)
+    idx = np.where(known, np.arange(len(values)), 0)
+    np.maximum.accumulate(idx, out=idx)
+    return values[idx]
+
+
+def parse_entsoe_da(content, start, end):
+    """
+    Streams an ENTSO-E A44 (day-ahead prices) document into 15-minute arrays covering [start, end).
+    Returns (timestamps as datetime64[m] UTC, prices as float64) for the slots the document covers.
+    Hourly or half-hourly periods are expanded to quarter hours and positions omitted by the
+    A03 curve type repeat the previous price.
+    """
+    start = np.datetime64(start, "m")
+    end = np.datetime64(end, "m")
+    n_slots = int((end - start) // SLOT)
+
+    prices = np.full(n_slots, np.nan)
+    known = np.zeros(n_slots, dtype=bool)
+    covered = np.zeros(n_slots, dtype=bool)
+
+    in_period = False
+    period_start = period_end = None
+    slots_per_point = 4
+    position = None
+
+    for event, elem in ET.iterparse(io.BytesIO(content), events=("start", "end")):
+        tag = local_tag(elem)
+
+        if event == "start":
+            if tag == "Period":
+                in_period = True
+                period_start = period_end = None
+                slots_per_point = 4
+            continue
+
+        if not in_period:
+            if tag == "TimeSeries":
+                elem.clear()
+            continue
+
+        if tag == "start":
+            period_start = to_datetime64(elem.text)
+        elif tag == "end":
+            period_end = to_datetime64(elem.text)
+        elif tag == "resolution":
+            slots_per_point = RESOLUTION_SLOTS[elem.text.strip()]
+        elif tag == "position":
+            position = int(elem.text)
+        elif tag == "price.amount":
+            first = int((period_start - start) // SLOT) + (position - 1) * slots_per_point
+            lo, hi = max(first, 0), min(first + slots_per_point, n_slots)
+            if lo < hi:
+                prices[lo:hi] = float(elem.text)
+                known[lo] = True
+        elif tag == "Period":
+            lo = max(int((period_start - start) // SLOT), 0)
+            hi = min(int((period_end - start) // SLOT), n_slots)
+            if lo < hi:
+                covered[lo:hi] = True
+            in_period = False
+            elem.clear()
+
+    prices = forward_fill(prices, known)
+    keep = covered & ~np.isnan(prices)
+    timestamps = start + np.arange(n_slots) * SLOT
+
+    return timestamps[keep], prices[keep]
@@ -0,0 +1,71 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+import httpx
+from .metrics import MARKET_FETCH_SECONDS
+from .config import HTTP_TIMEOUT, HTTP_RETRIES, HTTP_BACKOFF, HTTP_MAX_CONNECTIONS
+
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_client = None
+# concurrent day-by-day fetches of a long range queue here instead of timing out waiting for a pooled connection
+_request_slots = asyncio.Semaphore(HTTP_MAX_CONNECTIONS)
+
+
+def get_client() -> httpx.AsyncClient:
+    # one pooled client per process so market-data requests reuse keep-alive connections
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_TIMEOUT),
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def get_with_retries(url:str, params=None, headers=None, retries:int=HTTP_RETRIES, backoff:float=HTTP_BACKOFF) -> httpx.Response:
+    host = httpx.URL(url).host
+    started = time.perf_counter()
+    try:
+        response = await _get_with_retries(url, params, headers, retries, backoff)
+    except Exception:
+        MARKET_FETCH_SECONDS.observe(time.perf_counter() - started, host, "error")
+        raise
+    MARKET_FETCH_SECONDS.observe(time.perf_counter() - started, host, "ok")
+    return response
+
+
+async def _get_with_retries(url, params, headers, retries, backoff):
+    for attempt in range(retries + 1):
+        try:
+            async with _request_slots:
+                response = await get_client().get(url, params=params, headers=headers)
+            if response.status_code in RETRY_STATUS_CODES and attempt < retries:
+                print(f"{url} answered {response.status_code}, retrying")
+            else:
+                response.raise_for_status()
+                return response
+        except httpx.TransportError as err:
+            if attempt == retries:
+                raise
+            print(f"Request to {url} failed ({err!r}), retrying")
+
+        await asyncio.sleep(backoff * 2**attempt)
+
+
+def split_days(start_dt:datetime, end_dt:datetime):
+    # splits the half-open range [start_dt, end_dt) into chunks of at most one day, to be fetched concurrently
+    chunks = []
+    while start_dt < end_dt:
+        chunk_end = min(start_dt + timedelta(days=1), end_dt)
+        chunks.append((start_dt, chunk_end))
+        start_dt = chunk_end
+    return chunks
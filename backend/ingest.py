@@ -0,0 +1,123 @@
+import queue
+import threading
+import time
+from .db import pool
+from .rollups import update_rollups
+from .metrics import registry, pooled_connection, DB_INSERT_SECONDS, DB_INSERTED_ROWS, DB_INSERT_FAILURES, INGEST_DROPPED
+from .config import INGEST_BATCH_SIZE, INGEST_FLUSH_INTERVAL, INGEST_QUEUE_SIZE, INGEST_PUT_TIMEOUT
+
+
+COPY_POWER_READINGS_SQL = "COPY power_readings (timestamp, device_id, power) FROM STDIN"
+
+
+class PowerReadingWriter():
+    # Readings are queued by the MQTT thread and written in bulk by a single background thread,
+    # so the paho network loop never waits on a pool connection or a commit.
+    def __init__(self, batch_size:int=500, flush_interval:float=2.0, max_queue:int=10000, put_timeout:float=1.0, db_pool=pool):
+        self.db_pool = db_pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="power-reading-writer", daemon=True)
+                self._thread.start()
+
+    def put(self, device_id, power, timestamp, store:bool=True, rollup:bool=True):
+        # store: write the reading to power_readings, rollup: fold it into the energy rollups.
+        # Filtered telemetry sends every sample to the rollups once but only stores the kept ones.
+        self.start()
+        try:
+            # blocks the producer for at most put_timeout when the writer falls behind (backpressure),
+            # afterwards the reading is dropped instead of stalling the MQTT loop indefinitely
+            self.queue.put((timestamp, device_id, power, store, rollup), timeout=self.put_timeout)
+        except queue.Full:
+            self.dropped += 1
+            INGEST_DROPPED.inc()
+            print(f"Power reading queue full, dropped {self.dropped} readings so far")
+
+    def flush(self, timeout:float=10.0):
+        # everything queued before the flush marker is written before the marker is acknowledged
+        self.start()
+        done = threading.Event()
+        try:
+            self.queue.put(done, timeout=timeout)
+        except queue.Full:
+            print("Power reading queue full, flush not scheduled")
+            return False
+        return done.wait(timeout)
+
+    def _run(self):
+        batch = []
+        deadline = None
+
+        while True:
+            timeout = None if not batch else max(0.0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, threading.Event):
+                self._write(batch)
+                batch = []
+                item.set()
+                continue
+
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+                if len(batch) < self.batch_size:
+                    continue
+
+            self._write(batch)
+            batch = []
+
+    def _write(self, batch):
+        if not batch:
+            return
+        started = time.perf_counter()
+        try:
+            with pooled_connection(self.db_pool, "ingest") as conn:
+                with conn.cursor() as cur:
+                    with cur.copy(COPY_POWER_READINGS_SQL) as copy:
+                        for timestamp, device_id, power, store, _ in batch:
+                            if store:
+                                copy.write_row((timestamp, device_id, power))
+                    try:
+                        # savepoint, so a rollup failure never loses the raw readings
+                        with conn.transaction():
+                            update_rollups(cur, [
+                                (timestamp, device_id, power)
+                                for timestamp, device_id, power, _, rollup in batch if rollup
+                            ])
+                    except Exception as err:
+                        print(f"Failed to update energy rollups: {err}")
+        except Exception as err:
+            DB_INSERT_FAILURES.inc()
+            print(f"Failed to write {len(batch)} power readings: {err}")
+            return
+        DB_INSERT_SECONDS.observe(time.perf_counter() - started)
+        DB_INSERTED_ROWS.inc(amount=sum(1 for item in batch if item[3]))
+
+
+power_writer = PowerReadingWriter(
+    batch_size=INGEST_BATCH_SIZE,
+    flush_interval=INGEST_FLUSH_INTERVAL,
+    max_queue=INGEST_QUEUE_SIZE,
+    put_timeout=INGEST_PUT_TIMEOUT,
+)
+
+registry.gauge(
+    "ingest_queue_depth", "Power readings waiting for the background writer",
+    callback=lambda: {(): power_writer.queue.qsize()},
+)
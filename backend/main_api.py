@@ -1,21 +1,76 @@
 import asyncio
-from fastapi import FastAPI, WebSocket, BackgroundTasks, Response, Depends
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, WebSocket, BackgroundTasks, Response, Depends, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 import json
+from typing import Optional
 from datetime import datetime, timezone
 from pydantic import BaseModel
 from passlib.context import CryptContext
 from .utils import *
 from .mqtt_class import *
-from .db import pool
-from .session_manager import session
-from .config import MQTT_SERVER, MQTT_PORT, SHELLY_ID, APP_USERNAME, APP_PASSWORD
+from .db import pool, async_pool
+from .ingest import power_writer
+from .session_manager import registry, resume_sessions
+from .session_store import cancel_device_sessions, fetch_session_summary
+from .session_energy import session_meters
+from .reoptimizer import price_watch
+from .price_providers import provider_for
+from .price_forecast import forecast_slot_prices
+from .partitions import run_storage_maintenance
+from .cost_engine import historic_costs, GRANULARITIES
+from .broadcast import hub
+from .http_client import close_client
+from .recent_readings import recent_readings
+from .downsampling import downsample, METHODS as DOWNSAMPLING_METHODS
+from .serialization import negotiate_format, series_response
+from .metrics import registry as metrics_registry, HTTP_REQUEST_SECONDS, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from .config import MQTT_SERVER, MQTT_PORT, SHELLY_ID, APP_USERNAME, APP_PASSWORD, MAINTENANCE_INTERVAL_HOURS, DEFAULT_CHART_POINTS, WS_BACKFILL_SECONDS
 
 #pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 #hashed_password = pwd_context.hash(PASSWORD)
 
-app = FastAPI()
+
+async def storage_maintenance():
+    # keeps upcoming power_readings partitions created and applies the retention policy
+    while True:
+        try:
+            await asyncio.to_thread(run_storage_maintenance)
+        except Exception as err:
+            print(f"Storage maintenance failed: {err}")
+        await asyncio.sleep(MAINTENANCE_INTERVAL_HOURS * 3600)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await async_pool.open()
+    registry.start(asyncio.get_running_loop())
+    try:
+        # DDL and migrations run here once, request handlers and sessions assume the schema exists
+        await asyncio.to_thread(create_table)
+    except Exception as err:
+        print(f"Could not prepare database tables: {err}")
+    try:
+        await resume_sessions()
+    except Exception as err:
+        print(f"Could not resume charging sessions: {err}")
+    maintenance_task = asyncio.create_task(storage_maintenance())
+    price_watch_task = asyncio.create_task(price_watch())
+
+    yield
+
+    maintenance_task.cancel()
+    price_watch_task.cancel()
+    registry.close()
+    await close_client()
+    # readings still queued for the writer thread (a daemon) would be lost, it writes through the sync pool
+    await asyncio.to_thread(power_writer.flush)
+    await async_pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "https://not-a-smart-charger-app-s23i.vercel.app",
@@ -31,6 +86,23 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # labelled by route template rather than raw path, so query strings and ids don't explode the series
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            request.method, route.path if route is not None else "unmatched", str(status)
+        )
+
+
 class LoginRequest(BaseModel):
     username: str
     password: str
@@ -40,51 +112,65 @@ class LoginRequest(BaseModel):
 def root():
     return {"message": "Hello, backend server is running!"}
 
+def check_device(device_id: str):
+    if not registry.is_known(device_id):
+        raise HTTPException(status_code=404, detail=f"Unknown device {device_id}")
+
+
 @app.websocket("/ws/power")
-async def websocket_endpoint(ws: WebSocket):
+async def websocket_endpoint(ws: WebSocket, device_id: str = SHELLY_ID, backfill: int = WS_BACKFILL_SECONDS):
     await ws.accept()
-    clients.add(ws)
+    # the last `backfill` seconds come from memory and are sent first, live readings queue up behind them
+    _, epochs, power = recent_readings.window(time.time() - backfill, device_id)
+    history = [
+        {"device_id": device_id, "power": power_value, "timestamp": datetime.fromtimestamp(epoch, timezone.utc).isoformat()}
+        for epoch, power_value in zip(epochs.tolist(), power.tolist())
+    ]
+    subscriber = hub.subscribe(device_id, ws, history)
     try:
         while True:
             await ws.receive_text()  
     except:
-        clients.remove(ws)
+        hub.unsubscribe(subscriber)
 
 
 @app.post("/api/charge")
-async def start_charge(start_charge_timestamp:str, hours:int,minutes:int,soc:int):
-    
+async def start_charge(start_charge_timestamp:str, hours:int,minutes:int,soc:int, device_id:str = SHELLY_ID):
+    check_device(device_id)
+    session = registry.session(device_id)
+
     #if session.task and not session.task.done():
     #    print("Already Charging")
     #    return {"status": "already charging"}
 
     loop = asyncio.get_running_loop()
-    controller = MQTTClass(
-        device_id= SHELLY_ID,
-        broker= MQTT_SERVER,
-        port=MQTT_PORT,
-        loop=loop
-    )
-    controller.connect()
-    controller.check_online_status()
+    controller = registry.controller(device_id, loop)
+    online = await controller.wait_online()
     
     print("Starting charging session")
 
     session.controller = controller
     session.task = asyncio.create_task(charge(start_charge_timestamp, hours, minutes, soc, controller))
 
-    return {"status":"started"}
+    return {"status":"started", "online": online}
+
+
+@app.get("/api/ready")
+def ready():
+    # 503 until the MQTT broker connection is up; per-device online state is reported but does not gate readiness
+    readiness = registry.readiness()
+    return JSONResponse(readiness, status_code=200 if readiness["ready"] else 503)
 
 
 @app.post("/api/save_session")
-def save_session(start_charge_timestamp:str, hours:int,minutes:int,soc:int):
-    save_sessions_to_db(start_charge_timestamp, hours, minutes, soc)
+async def save_session(start_charge_timestamp:str, hours:int,minutes:int,soc:int):
+    await save_sessions_to_db(start_charge_timestamp, hours, minutes, soc)
     print("Saving session to db")
     return {"status": "saving session to db"}
 
 @app.get("/api/select_latest_session")
-def select_latest_session(start_charge_timestamp:str, hours:int,minutes:int,soc:int):
-    rows = select_latest_session_from_db(start_charge_timestamp, hours, minutes, soc)
+async def select_latest_session(start_charge_timestamp:str, hours:int,minutes:int,soc:int):
+    rows = await select_latest_session_from_db(start_charge_timestamp, hours, minutes, soc)
     print("Collecting latest session data")
     return [{
         "start_charge_timestamp": start_charge_timestamp,
@@ -96,56 +182,108 @@ def select_latest_session(start_charge_timestamp:str, hours:int,minutes:int,soc:
     ]
 
 
+@app.get("/api/session_summary")
+async def session_summary(session_id: Optional[int] = None, device_id: str = SHELLY_ID):
+    # energy and cost of one charging session (the latest of the device without session_id), read from its
+    # row; a running session reports its live meter instead of the totals stored at its last save
+    summary = await fetch_session_summary(session_id, device_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="No charging session found")
+
+    meter = session_meters.session(summary["session_id"])
+    if meter is not None:
+        summary.update(meter.totals())
+    return summary
+
+
 @app.get("/api/charging_schedule")
-async def get_charging_schedule(start_charge_timestamp:str, hours: int, soc: int):
-    pvpc_prices = get_prices_pvpc(start_charge_timestamp)
-    charging_hours = select_cheapest_hours(start_charge_timestamp, pvpc_prices, hours, soc)
+async def get_charging_schedule(start_charge_timestamp:str, hours: int, soc: int, minutes: int = 0, device_id: str = SHELLY_ID):
+    intervals, _, _ = await plan_charging(start_charge_timestamp, hours, minutes, soc, device_id=device_id)
 
     return {
-        "charging_hours": charging_hours
+        "charging_hours": charging_hours_from_intervals(intervals),
+        "charging_slots": [{"start": on.isoformat(), "end": off.isoformat()} for on, off in intervals]
     }
 
+@app.get("/api/price_forecast")
+async def get_price_forecast(hours: int = 48, device_id: str = SHELLY_ID):
+    # the device's market prices for the next `hours` hours per quarter hour, unpublished ones forecast with 80% bounds
+    spain_tz = ZoneInfo("Europe/Madrid")
+    start = datetime.now(spain_tz)
+    timestamps, prices, lower, upper, forecasted = await forecast_slot_prices([provider_for(device_id)], start, start + timedelta(hours=hours))
+
+    return [
+        {
+            "start": datetime.fromtimestamp(epoch, spain_tz).isoformat(),
+            "price": None if np.isnan(price) else price,
+            "lower": None if np.isnan(low) else low,
+            "upper": None if np.isnan(high) else high,
+            "forecast": is_forecast,
+        }
+        for epoch, price, low, high, is_forecast in zip(
+            timestamps.tolist(), prices[0].tolist(), lower[0].tolist(), upper[0].tolist(), forecasted[0].tolist()
+        )
+    ]
+
 @app.get("/api/power")
-def get_power(hours: int = 24):
-    with pool.connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT
-                    timestamp,
-                    power
-                FROM power_readings
-                WHERE timestamp > NOW() - (%s * INTERVAL '1 hour')
-                ORDER BY timestamp ASC
-            """, (hours,))
-            rows = cur.fetchall()
+async def get_power(request: Request, hours: int = 24, points: Optional[int] = None, resolution: str = "raw", device_id: str = SHELLY_ID, format: Optional[str] = None):
+    # with points (or resolution=lttb|minmax) the series is downsampled to at most ~points readings
+    if resolution not in ("raw", *DOWNSAMPLING_METHODS):
+        raise HTTPException(status_code=400, detail=f"resolution must be raw, {' or '.join(DOWNSAMPLING_METHODS)}")
+    if resolution != "raw" and not points:
+        points = DEFAULT_CHART_POINTS
+    fmt = negotiate_format(request, format)
+
+    epochs, power = await recent_power_series(hours, device_id)
+    if points and resolution == "raw":
+        resolution = "lttb"
+    if points:
+        epochs, power = downsample(epochs, power, points, resolution)
+
+    if fmt != "rows":
+        return series_response(fmt, epochs, power, "power")
 
     return [
         {
-            "timestamp": timestamp.isoformat(),
-            "power": float(power),
+            "timestamp": datetime.fromtimestamp(epoch, timezone.utc).isoformat(),
+            "power": power_value,
         }
-        for timestamp, power in rows
+        for epoch, power_value in zip(epochs.tolist(), power.tolist())
     ]
 
 @app.post("/api/stop_charging")
-async def stop_charging():
+async def stop_charging(device_id:str = SHELLY_ID):
+    check_device(device_id)
+    session = registry.session(device_id)
     if session.controller is None:
         return {"status": "no active charging session"}
 
-    await asyncio.to_thread(session.controller.force_stop_charging)
-
+    # cancelling the task cancels its scheduled transitions straight away, so the plan cannot switch the plug back on
     if session.task:
         session.task.cancel()
         session.task = None
+    # only an explicit stop ends the stored session, a shutdown leaves it active so it is resumed on restart
+    await cancel_device_sessions(device_id)
+
+    await session.controller.force_stop_charging()
 
     session.controller = None
 
     return {"status": "stopping charging"}
 
 @app.get("/api/get_historic_power")
-def get_historic_power(start_dt, end_dt):
+async def get_historic_power(request: Request, start_dt, end_dt, device_id: Optional[str] = None, format: Optional[str] = None):
 
-    results = extract_power_readings(start_dt, end_dt)
+    fmt = negotiate_format(request, format)
+    results = await extract_power_readings(start_dt, end_dt, device_id)
+
+    if fmt != "rows":
+        return series_response(
+            fmt,
+            [int(timestamp.astimezone(timezone.utc).timestamp()) for timestamp, _ in results],
+            [power for _, power in results],
+            "power"
+        )
 
     return [
         {
@@ -156,9 +294,18 @@ def get_historic_power(start_dt, end_dt):
     ]
 
 @app.get("/api/get_historic_pvpc_prices")
-def get_historic_prices_pvpc(start_dt, end_dt):
+async def get_historic_prices_pvpc(request: Request, start_dt, end_dt, format: Optional[str] = None):
+
+    fmt = negotiate_format(request, format)
+    results = await historic_prices_pvpc(start_dt, end_dt)
 
-    results = historic_prices_pvpc(start_dt, end_dt)
+    if fmt != "rows":
+        return series_response(
+            fmt,
+            [int(datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp()) for timestamp, _ in results],
+            [prices for _, prices in results],
+            "price"
+        )
 
     return [
         {
@@ -169,36 +316,16 @@ def get_historic_prices_pvpc(start_dt, end_dt):
     ]
 
 @app.get("/api/get_historic_cost")
-def get_historic_costs(start_dt:str,end_dt:str):
-
-    power_consumption = get_historic_power(start_dt, end_dt)
-    pvpc_prices = get_historic_prices_pvpc(start_dt, end_dt)
-
-    power_consumption_df = pd.DataFrame(power_consumption)
-    pvpc_prices_df = pd.DataFrame(pvpc_prices)
-    print(power_consumption_df)
-    print(pvpc_prices_df)
-    merged_df = power_consumption_df.merge(
-        pvpc_prices_df,
-        on="timestamp",
-        how="inner" 
-    )
-
-    merged_df["cost"] = merged_df["power"]/1e6 * merged_df["price"]
+async def get_historic_costs(start_dt:str,end_dt:str, granularity:str="month", device_id: Optional[str] = None):
 
-    merged_df["timestamp"] = pd.to_datetime(merged_df["timestamp"], utc=True)
-    merged_df["timestamp_spain"] = merged_df["timestamp"].dt.tz_convert("Europe/Madrid")
+    if granularity not in GRANULARITIES:
+        raise HTTPException(status_code=400, detail=f"granularity must be one of {', '.join(GRANULARITIES)}")
 
-    merged_df["year"] = merged_df["timestamp_spain"].dt.year
-    merged_df["month"] = merged_df["timestamp_spain"].dt.month
-
-    monthly_costs = (
-        merged_df
-        .groupby(["year", "month"], as_index=False)
-        .agg(total_cost=("cost", "sum"))
-    )
+    return await historic_costs(start_dt, end_dt, granularity, device_id)
 
-    return monthly_costs.to_dict(orient="records")
+@app.get("/metrics")
+def metrics():
+    return Response(content=metrics_registry.render(), media_type=METRICS_CONTENT_TYPE)
 
 @app.get("/uptime_bot")
 async def uptime_bot_check():
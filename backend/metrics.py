@@ -0,0 +1,219 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric():
+    # Label values are passed positionally in the order of label_names. Every update takes one uncontended
+    # lock and touches a dict entry, so it is cheap enough for the paho network thread and the ingest writer.
+    kind = "untyped"
+
+    def __init__(self, name:str, documentation:str, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self.label_names, labels, value) for labels, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, label_names, labels, value in self.samples():
+            lines.append(f"{name}{format_labels(label_names, labels)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount:float=1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels) -> float:
+        with self._lock:
+            return self._values.get(labels, 0.0)
+
+
+class Gauge(Metric):
+    # set from the code being measured, or read from `callback` at scrape time; the callback returns
+    # {label values tuple: value} and is used for state that already lives elsewhere (queue depths, pool stats)
+    kind = "gauge"
+
+    def __init__(self, name:str, documentation:str, label_names=(), callback=None):
+        super().__init__(name, documentation, label_names)
+        self.callback = callback
+
+    def set(self, value:float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount:float=1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def dec(self, *labels, amount:float=1.0):
+        self.inc(*labels, amount=-amount)
+
+    def samples(self):
+        if self.callback is None:
+            return super().samples()
+        try:
+            values = self.callback()
+        except Exception as err:
+            print(f"Metric {self.name} unavailable: {err}")
+            return []
+        return [(self.name, self.label_names, labels, value) for labels, value in values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name:str, documentation:str, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value:float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # per-bucket (not cumulative) counts, the running sum and the observation count
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self._lock:
+            states = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._values.items()]
+
+        samples = []
+        bucket_names = self.label_names + ("le",)
+        for labels, counts, total, count in states:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", bucket_names, labels + (format_value(bound),), cumulative))
+            samples.append((f"{self.name}_sum", self.label_names, labels, total))
+            samples.append((f"{self.name}_count", self.label_names, labels, count))
+        return samples
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric:Metric) -> Metric:
+        with self._lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name:str, documentation:str, label_names=()) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name:str, documentation:str, label_names=(), callback=None) -> Gauge:
+        return self.register(Gauge(name, documentation, label_names, callback))
+
+    def histogram(self, name:str, documentation:str, label_names=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        with self._lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+MQTT_MESSAGES = registry.counter(
+    "mqtt_messages_total", "MQTT messages received per device and topic kind", ("device_id", "kind"))
+MQTT_CALLBACK_SECONDS = registry.histogram(
+    "mqtt_callback_seconds", "Time spent in the paho on_message callback", ("kind",))
+
+TELEMETRY_SAMPLES = registry.counter(
+    "telemetry_samples_total", "Power samples seen by the ingest filter by decision", ("device_id", "decision"))
+
+DB_INSERT_SECONDS = registry.histogram(
+    "db_insert_seconds", "Time to COPY a batch of power readings and update the rollups")
+DB_INSERTED_ROWS = registry.counter(
+    "db_inserted_rows_total", "Power readings written to power_readings")
+DB_INSERT_FAILURES = registry.counter(
+    "db_insert_failures_total", "Batches of power readings that could not be written")
+DB_POOL_WAIT_SECONDS = registry.histogram(
+    "db_pool_wait_seconds", "Time spent waiting for a pool connection", ("caller",))
+INGEST_DROPPED = registry.counter(
+    "ingest_dropped_readings_total", "Power readings dropped because the ingest queue was full")
+
+MARKET_FETCH_SECONDS = registry.histogram(
+    "market_fetch_seconds", "Latency of market data requests including retries", ("host", "outcome"))
+PRICE_SLOTS = registry.counter(
+    "price_slots_total", "Price slots requested from the price store by where they were found", ("source", "origin"))
+
+WS_SEND_SECONDS = registry.histogram(
+    "ws_send_seconds", "Time to send one message to a WebSocket subscriber")
+WS_DROPPED = registry.counter(
+    "ws_dropped_messages_total", "Messages dropped for slow WebSocket subscribers", ("device_id",))
+
+POWER_SERIES_READS = registry.counter(
+    "power_series_reads_total", "Power series requests by where the readings came from", ("source",))
+
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "http_request_seconds", "HTTP request latency per endpoint", ("method", "route", "status"))
+
+
+@contextmanager
+def pooled_connection(pool, caller:str):
+    # pool.connection() that records how long the caller waited for a free connection
+    started = time.perf_counter()
+    with pool.connection() as conn:
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started, caller)
+        yield conn
+
+
+@asynccontextmanager
+async def async_pooled_connection(pool, caller:str):
+    started = time.perf_counter()
+    async with pool.connection() as conn:
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started, caller)
+        yield conn
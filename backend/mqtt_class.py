@@ -1,43 +1,44 @@
 import asyncio
-from datetime import datetime, timedelta
 import paho.mqtt.client as mqtt
 import json
 import time
 from datetime import datetime, timezone
-from zoneinfo import ZoneInfo
-from .db import pool
+from .ingest import power_writer
+from .broadcast import hub
+from .recent_readings import recent_readings
+from .session_energy import session_meters
+from .telemetry_filter import make_filter
+from .metrics import MQTT_MESSAGES, MQTT_CALLBACK_SECONDS, TELEMETRY_SAMPLES
+from .config import TELEMETRY_FILTER, TELEMETRY_DEADBAND_W, TELEMETRY_COMPRESSION_W, TELEMETRY_MAX_SILENCE
+from .config import SWITCH_ACK_TIMEOUT, SWITCH_RETRIES, MQTT_ONLINE_TIMEOUT, MQTT_RECONNECT_MAX_DELAY
 
 
-def seconds_until_next_hour():
-    now = datetime.now()
-    next_hour = (now + timedelta(hours=1)).replace(
-        minute=0, second=0, microsecond=0
-    )
-    return (next_hour - now).total_seconds()
+class SwitchTimeoutError(Exception):
+    pass
 
-clients = set()
-async def broadcast_power(power):
+
+def broadcast_power(power, device_id, loop, timestamp=None):
     message = {
+        "device_id": device_id,
         "power": power,
-        "timestamp": datetime.now(timezone.utc).isoformat()
+        "timestamp": timestamp or datetime.now(timezone.utc).isoformat()
     }
-    for ws in clients:
-        await ws.send_text(json.dumps(message))
-
-def save_power_reading(device_id, power, timestamp):
-    with pool.connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO power_readings (timestamp, device_id, power)
-                VALUES (%s, %s, %s)
-                """,
-                (timestamp, device_id, power)
-            )
+    hub.publish_threadsafe(loop, device_id, message)
+
+def save_power_reading(device_id, power, timestamp, store=True, rollup=True):
+    # queued for the background writer, which flushes readings in bulk; stored readings are also kept in memory for live charts
+    if store:
+        recent_readings.append(device_id, datetime.fromisoformat(timestamp).timestamp(), power)
+    power_writer.put(device_id, power, timestamp, store=store, rollup=rollup)
+
+def _acknowledge(future, state):
+    if not future.done():
+        future.set_result(state)
 
 class MQTTClass():
-    def __init__(self, device_id:str= "", broker:str="", port:int=None, loop:str=""):
+    def __init__(self, device_id:str= "", broker:str="", port:int=None, loop:str="", client:mqtt.Client=None, store_readings:bool=True):
         self.device_id = device_id
+        self.store_readings = store_readings # False only broadcasts, for benchmarks
         self.broker = broker
         self.port = port
         self.loop = loop
@@ -46,167 +47,245 @@ class MQTTClass():
         self.switch_status_topic = f"{device_id}/status/switch:0"
         self.event_topic = f"{device_id}/events/rpc"
         self.status_topic = f"{device_id}/status"
+        self.online_topic = f"{device_id}/online" # retained by the plug, its last will publishes false
         self.command_topic = f"{device_id}/command"
 
-        self.client = mqtt.Client(client_id=f"{device_id} MQTT Client", userdata={"loop": loop})
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
+        # when a shared broker client is passed in, the BrokerConnection owns its network loop and routes messages here
+        self.owns_client = client is None
+        if self.owns_client:
+            self.client = mqtt.Client(client_id=f"{device_id} MQTT Client", userdata={"loop": loop})
+            self.client.on_connect = self.on_connect
+            self.client.on_message = self.on_message
+        else:
+            self.client = client
 
         self.last_status = None
         self.last_power = None
         self.switch_on = False
         self.connected = False
+        self.online_event = asyncio.Event()
 
         self.switch_map = {True: "on", False: "off"}
+        # futures of switch commands waiting for the plug to report the requested state, resolved from the MQTT thread
+        self.switch_waiters = {True: set(), False: set()}
+
+        # drops redundant samples (steady charging, relay off at 0 W) before broadcast and storage
+        self.telemetry_filter = make_filter(
+            TELEMETRY_FILTER,
+            deadband_w=TELEMETRY_DEADBAND_W,
+            compression_w=TELEMETRY_COMPRESSION_W,
+            max_silence=TELEMETRY_MAX_SILENCE,
+        )
 
 
     def connect(self):
         self.client.connect(self.broker, self.port, 60)
         self.client.loop_start()
 
+    @property
+    def topics(self):
+        return [self.switch_status_topic, self.event_topic, self.status_topic, self.online_topic]
+
     def on_connect(self, client, userdata, flags, rc):
-        print("Subscribing to MQTT broker")
-        client.subscribe(self.switch_status_topic)
-        client.subscribe(self.event_topic)
-        client.subscribe(self.status_topic)
+        print(f"Subscribing {self.device_id} to MQTT broker")
+        for topic in self.topics:
+            client.subscribe(topic)
 
         self.client.publish(self.command_topic, "status_update")
 
-    def check_online_status(self):
+    def set_online(self, online:bool):
+        # called from the MQTT thread, the event is only touched on the event loop
+        if online != self.connected:
+            print('Device plugged and connected' if online else f'{self.device_id} went offline')
+        self.connected = online
+        if isinstance(self.loop, asyncio.AbstractEventLoop):
+            self.loop.call_soon_threadsafe(self.online_event.set if online else self.online_event.clear)
+
+    async def wait_online(self, timeout:float=MQTT_ONLINE_TIMEOUT) -> bool:
+        # awaits the plug's status reply instead of sleeping, the event loop keeps serving other requests meanwhile
+        if self.connected:
+            return True
         print('Checking if device connected:')
-
-        start_time = time.time()
-        timeout = 5
-        while self.connected is False and (time.time() - start_time) < timeout:
-            time.sleep(1)
-
-        if not self.connected:
+        self.client.publish(self.command_topic, "status_update")
+        try:
+            await asyncio.wait_for(self.online_event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
             print('Device not connected')
-            
-
+            return False
+
+    def topic_kind(self, topic:str) -> str:
+        if topic == self.event_topic:
+            return "event"
+        if topic == self.switch_status_topic:
+            return "switch_status"
+        if topic == self.status_topic:
+            return "status"
+        if topic == self.online_topic:
+            return "online"
+        return "other"
 
     def on_message(self, client, userdata, msg):
+        kind = self.topic_kind(msg.topic)
+        MQTT_MESSAGES.inc(self.device_id, kind)
+        started = time.perf_counter()
+        try:
+            self.handle_message(msg)
+        finally:
+            MQTT_CALLBACK_SECONDS.observe(time.perf_counter() - started, kind)
+
+    def handle_message(self, msg):
         payload = json.loads(msg.payload.decode())
 
         if msg.topic == self.switch_status_topic:
             self.last_status = payload
-            self.switch_on = payload.get("output", self.switch_on)
+            if "output" in payload:
+                self.switch_state_reported(payload["output"])
             if 'apower' in payload.keys():
-                self.last_power = payload.get("apower", 0)
-                asyncio.run_coroutine_threadsafe(broadcast_power(self.last_power), userdata['loop'])
-                save_power_reading(
-                    device_id=self.device_id,
-                    power=self.last_power,
-                    timestamp = datetime.now(timezone.utc).isoformat()
-                )
+                self.record_power(payload.get("apower", 0))
                 #print("Power consumed: ",self.last_power)
 
         elif msg.topic == self.event_topic:
             try:
                 params = payload["params"]["switch:0"]
+                if "output" in params:
+                    self.switch_state_reported(params["output"])
                 #if "apower" in params:
                 if "apower" in params: #and datetime.now().second>57: # comment and uncomment above if want data every second and not minute
-                    self.last_power = params["apower"]
-                    asyncio.run_coroutine_threadsafe(broadcast_power(self.last_power), userdata['loop'])
-                    save_power_reading(
-                        device_id=self.device_id,
-                        power=self.last_power,
-                        timestamp = datetime.now(timezone.utc).isoformat()
-                    )
+                    self.record_power(params["apower"])
                     #print("Power consumed: ",self.last_power)
             except KeyError:
                 pass
 
         elif msg.topic == self.status_topic:
             if payload["mqtt"]["connected"] == True:
-                self.connected = True
-                print('Device plugged and connected')
-        
+                self.set_online(True)
+
+        elif msg.topic == self.online_topic:
+            self.set_online(payload is True)
+
+
+    def record_power(self, power):
+        self.last_power = power
+        now = datetime.now(timezone.utc)
+        session_meters.offer(self.device_id, now.timestamp(), power) # every raw sample, before any filtering
+        if self.telemetry_filter is None:
+            broadcast_power(power, self.device_id, self.loop)
+            self.save_reading(power, now.isoformat())
+            return
+
+        # every sample goes into the energy rollups exactly once, at arrival, so energy totals are the
+        # same as without filtering; power_readings and the WebSocket only get the published points
+        epoch = now.timestamp()
+        points = self.telemetry_filter.offer(power, epoch)
+        kept = bool(points) and points[-1][0] == epoch
+        TELEMETRY_SAMPLES.inc(self.device_id, "kept" if kept else "dropped")
+
+        for point_epoch, point_power in points:
+            timestamp = datetime.fromtimestamp(point_epoch, timezone.utc).isoformat()
+            broadcast_power(point_power, self.device_id, self.loop, timestamp)
+            if point_epoch != epoch:
+                self.save_reading(point_power, timestamp, rollup=False) # held point, already counted
+        self.save_reading(power, now.isoformat(), store=kept)
+
+    def save_reading(self, power, timestamp, store=True, rollup=True):
+        if self.store_readings:
+            save_power_reading(self.device_id, power, timestamp, store=store, rollup=rollup)
 
     def set_switch(self, state: bool):
         print(f"Setting switch {self.switch_map[state]}")
         self.client.publish(self.switch_command_topic , self.switch_map[state])
 
-    def confirm_switch_state(self, state):
-        while True:
-            try:
-                self.client.publish(self.switch_command_topic , "status_update")
-                if self.switch_on == state:
+    def switch_state_reported(self, state:bool):
+        self.switch_on = state
+        for future in tuple(self.switch_waiters[state]):
+            future.get_loop().call_soon_threadsafe(_acknowledge, future, state)
+
+    async def switch(self, state: bool, timeout:float=SWITCH_ACK_TIMEOUT, retries:int=SWITCH_RETRIES):
+        # Sends the command and waits for status/switch:0 to report the state. An unacknowledged command is
+        # sent again with a doubled wait each time; after the last retry SwitchTimeoutError is raised.
+        future = asyncio.get_running_loop().create_future()
+        self.switch_waiters[state].add(future)
+        try:
+            for attempt in range(retries + 1):
+                self.set_switch(state)
+                # the plug only reports its switch status on a change, so an already applied command is acknowledged through this
+                self.client.publish(self.switch_command_topic, "status_update")
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), timeout * 2 ** attempt)
                     print("Confirmed")
-                    break
-                else:
-                    print("Not confirmed")
-                    self.set_switch(state)                    
+                    return
+                except asyncio.TimeoutError:
+                    print(f"Switch {self.switch_map[state]} not confirmed by {self.device_id} (attempt {attempt + 1} of {retries + 1})")
+            raise SwitchTimeoutError(f"{self.device_id} did not confirm switching {self.switch_map[state]}")
+        finally:
+            self.switch_waiters[state].discard(future)
+            future.cancel()
+
+    async def force_stop_charging(self):
+
+        try:
+            await self.switch(False)
+        except SwitchTimeoutError as err:
+            print(f"Stop not confirmed: {err}")
+        if self.owns_client:
+            self.client.loop_stop()
+        await asyncio.to_thread(power_writer.flush)
 
-            except:
-                self.set_switch(state) 
-
-            time.sleep(1)
+        return self.switch_on
 
 
-    @staticmethod
-    def hour_match(hours):
-        spain_tz = ZoneInfo("Europe/Madrid")
-        spain_time_now = datetime.now(spain_tz)
-        return spain_time_now.hour in hours
+class BrokerConnection():
+    # One paho client (and one network thread) per broker, shared by every device on that broker.
+    # Incoming messages are routed to the device's MQTTClass by the "<device_id>/" topic prefix.
+    # The network thread reconnects on its own and every device is subscribed again on each connect.
+    def __init__(self, broker:str, port:int, loop=None):
+        self.broker = broker
+        self.port = port
+        self.loop = loop
+        self.devices = {}
+        self.connected = False
 
+        self.client = mqtt.Client(client_id=f"charger-backend {broker}:{port}", userdata={"loop": loop})
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+        self.client.reconnect_delay_set(min_delay=1, max_delay=MQTT_RECONNECT_MAX_DELAY)
 
-    def run_charging_schedule(self, hours, end_charge_hour):
-        print("Charging hours:", hours)
-        spain_tz = ZoneInfo("Europe/Madrid")
-        spain_time_now = datetime.now(spain_tz)
-        end_date = spain_time_now.replace(hour=end_charge_hour, minute=0, second=0, microsecond=0)
+    def connect(self):
+        # returns straight away, the network thread keeps retrying until the broker is reachable
+        self.client.connect_async(self.broker, self.port, 60)
+        self.client.loop_start()
 
-        if end_date <= spain_time_now:
-            end_date += timedelta(days=1)
-            
-        save_power_reading(
-            device_id=self.device_id,
-            power=0,
-            timestamp = spain_time_now.astimezone(timezone.utc).isoformat()
-        )
-        
-        while spain_time_now < end_date: # change to while datetime.now() < user_inputted_end_hour
-            spain_time_now = datetime.now(spain_tz)
-            if self.hour_match(hours):
-                self.set_switch(True)
-                self.confirm_switch_state(True)
-                while self.hour_match(hours) and spain_time_now < end_date:
-                    self.client.publish(self.switch_command_topic, "status_update")
-                    time.sleep(1)
-            else:
-                self.set_switch(False)
-                self.confirm_switch_state(False)
-
-                # saving 0 power value when charging hour ends to ensure it is plotted correctly (if last value is for ex. 40W then it will leave that point as last which looks like charging didn't end)
-                save_power_reading(
-                    device_id=self.device_id,
-                    power=0,
-                    timestamp = spain_time_now.astimezone(timezone.utc).isoformat()
-                )
-                
-                sleep_seconds = seconds_until_next_hour()
-                print("Minutes until next hourr: ", sleep_seconds/60)
-                time.sleep(sleep_seconds)
-
-        self.set_switch(False)
-        self.confirm_switch_state(False)
+    def close(self):
+        self.client.disconnect()
         self.client.loop_stop()
+        self.connected = False
 
-        # saving 0 power value when charging session ends to ensure it is plotted correctly (if last value is for ex. 40W then it will leave that point as last which looks like charging didn't end)
-        save_power_reading(
-            device_id=self.device_id,
-            power=0,
-            timestamp = spain_time_now.astimezone(timezone.utc).isoformat()
-        )
-
-    def force_stop_charging(self):
-
-        self.set_switch(False)
-        self.confirm_switch_state(False)
-        self.client.loop_stop()
+    def add_device(self, controller:MQTTClass):
+        self.devices[controller.device_id] = controller
+        if self.connected:
+            controller.on_connect(self.client, None, None, 0)
 
-        return self.switch_on
-        
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            print(f"MQTT broker {self.broker}:{self.port} refused the connection ({rc})")
+            return
+        print(f"Connected to MQTT broker {self.broker}:{self.port}")
+        self.connected = True
+        for controller in list(self.devices.values()):
+            controller.on_connect(client, userdata, flags, rc)
+
+    def on_disconnect(self, client, userdata, rc):
+        if self.connected:
+            print(f"Disconnected from MQTT broker {self.broker}:{self.port} ({rc}), reconnecting")
+        self.connected = False
+        # plugs cannot be reached until the broker is back, their status reply on reconnect marks them online again
+        for controller in list(self.devices.values()):
+            controller.set_online(False)
 
-    
+    def on_message(self, client, userdata, msg):
+        device_id = msg.topic.split("/", 1)[0]
+        controller = self.devices.get(device_id)
+        if controller is not None:
+            controller.on_message(client, userdata, msg)
@@ -0,0 +1,117 @@
+import re
+from datetime import datetime, timedelta, timezone
+import psycopg
+from .db import pool
+from .rollups import rebuild_rollups
+from .config import PARTITION_MONTHS_AHEAD, RAW_RETENTION_DAYS, ROLLUP_2M_RETENTION_DAYS
+
+
+CREATE_PARTITIONED_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS power_readings (
+        timestamp TIMESTAMPTZ NOT NULL,
+        device_id TEXT NOT NULL,
+        power DOUBLE PRECISION NOT NULL
+    ) PARTITION BY RANGE (timestamp);
+"""
+
+CREATE_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS idx_power_device_ts
+    ON power_readings (timestamp DESC, device_id);
+"""
+
+LIST_PARTITIONS_SQL = """
+    SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'power_readings'::regclass
+"""
+
+UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+
+def month_start(ts:datetime) -> datetime:
+    return ts.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(ts:datetime) -> datetime:
+    return (ts + timedelta(days=32)).replace(day=1)
+
+
+def partition_name(start:datetime) -> str:
+    return f"power_readings_p{start.year:04d}{start.month:02d}"
+
+
+def ensure_partitioned(cur):
+    # creates power_readings partitioned by month, turning an existing plain table into its first (legacy) partition
+    cur.execute("SELECT relkind FROM pg_class WHERE relname = 'power_readings' AND relkind IN ('r', 'p')")
+    row = cur.fetchone()
+
+    if row is not None and row[0] == "r":
+        print("Migrating power_readings to a partitioned table")
+        cur.execute("SELECT MAX(timestamp) FROM power_readings")
+        latest = cur.fetchone()[0] or datetime.now(timezone.utc)
+        cur.execute("ALTER TABLE power_readings RENAME TO power_readings_legacy")
+        cur.execute("ALTER INDEX IF EXISTS idx_power_device_ts RENAME TO idx_power_legacy_device_ts")
+        cur.execute(CREATE_PARTITIONED_TABLE_SQL)
+        cur.execute(
+            "ALTER TABLE power_readings ATTACH PARTITION power_readings_legacy "
+            f"FOR VALUES FROM (MINVALUE) TO ('{next_month(month_start(latest)).isoformat()}')"
+        )
+    else:
+        cur.execute(CREATE_PARTITIONED_TABLE_SQL)
+
+    cur.execute(CREATE_INDEX_SQL)
+    ensure_partitions(cur)
+
+
+def ensure_partitions(cur, months_ahead:int=PARTITION_MONTHS_AHEAD):
+    # the current month and the next months_ahead months always have a partition ready for inserts
+    start = month_start(datetime.now(timezone.utc))
+    for _ in range(months_ahead + 1):
+        end = next_month(start)
+        try:
+            with cur.connection.transaction():
+                cur.execute(
+                    f"CREATE TABLE IF NOT EXISTS {partition_name(start)} PARTITION OF power_readings "
+                    f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+                )
+        except psycopg.errors.InvalidObjectDefinition:
+            pass # range still covered by the legacy partition
+        start = end
+
+
+def list_partitions(cur):
+    cur.execute(LIST_PARTITIONS_SQL)
+    partitions = []
+    for name, bound in cur.fetchall():
+        match = UPPER_BOUND.search(bound or "")
+        if match:
+            partitions.append((name, datetime.fromisoformat(match.group(1)).astimezone(timezone.utc)))
+    return partitions
+
+
+def apply_retention(cur, raw_days:int=RAW_RETENTION_DAYS, rollup_2m_days:int=ROLLUP_2M_RETENTION_DAYS):
+    # Raw per-second readings are kept raw_days, 2-minute rollups rollup_2m_days and hourly rollups forever.
+    # A raw partition is only dropped once it lies completely outside the raw window and any rollup gaps are filled from it.
+    now = datetime.now(timezone.utc)
+    raw_cutoff = now - timedelta(days=raw_days)
+
+    for name, upper in list_partitions(cur):
+        if upper > raw_cutoff:
+            continue
+        cur.execute(f"SELECT MIN(timestamp), MAX(timestamp) FROM {name}")
+        start, end = cur.fetchone()
+        if start is not None:
+            rebuild_rollups(cur, start, end + timedelta(seconds=1))
+        print(f"Dropping raw partition {name}")
+        cur.execute(f"ALTER TABLE power_readings DETACH PARTITION {name}")
+        cur.execute(f"DROP TABLE {name}")
+
+    cur.execute("DELETE FROM power_rollup_2m WHERE bucket < %s", (now - timedelta(days=rollup_2m_days),))
+
+
+def run_storage_maintenance():
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            ensure_partitions(cur)
+            apply_retention(cur)
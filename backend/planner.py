@@ -0,0 +1,121 @@
+import numpy as np
+
+
+SLOT_SECONDS = 900 # quarter-hour slots, the ENTSO-E day-ahead resolution
+
+
+def energy_needed_kwh(soc:float, capacity_kwh:float) -> float:
+    return max(0.0, capacity_kwh * (1 - soc/100))
+
+
+def charger_power_kw(measured_w, default_kw:float, min_measured_w:float=50) -> float:
+    # the measured plug power is used once the charger has drawn something meaningful, otherwise the configured rating
+    if measured_w is not None and measured_w >= min_measured_w:
+        return measured_w / 1000
+    return default_kw
+
+
+def slots_needed(energy_kwh:float, power_kw:float, slot_seconds:int=SLOT_SECONDS) -> int:
+    if energy_kwh <= 0:
+        return 0
+    return int(np.ceil(energy_kwh / (power_kw * slot_seconds / 3600) - 1e-9))
+
+
+def window_mask(timestamps, start:float, end:float, slot_seconds:int=SLOT_SECONDS):
+    # only slots lying completely between the session start and the pick up time can be used
+    timestamps = np.asarray(timestamps)
+    return (timestamps >= start) & (timestamps + slot_seconds <= end)
+
+
+def expand_to_slots(timestamps, prices, step:int, slot_seconds:int=SLOT_SECONDS):
+    # repeats coarser (e.g. hourly PVPC) prices so every slot_seconds slot has its own entry
+    repeat = step // slot_seconds
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    offsets = np.arange(repeat, dtype=np.int64) * slot_seconds
+    return (timestamps[:, None] + offsets).ravel(), np.repeat(np.asarray(prices, dtype=np.float64), repeat)
+
+
+def cheapest_slots(prices, n_slots:int, available=None, min_run:int=1):
+    # Boolean mask of the n_slots cheapest available slots. Without a minimum run length this is a
+    # linear-time partial selection; with one, every charging run lasts at least min_run slots so
+    # the relay is not toggled for isolated quarter hours.
+    costs = np.asarray(prices, dtype=np.float64).copy()
+    if available is not None:
+        costs[~np.asarray(available, dtype=bool)] = np.inf
+    selectable = int(np.isfinite(costs).sum())
+    n_slots = min(n_slots, selectable)
+
+    selected = np.zeros(len(costs), dtype=bool)
+    if n_slots <= 0:
+        return selected
+    if n_slots == selectable:
+        selected[np.isfinite(costs)] = True
+        return selected
+    if min_run <= 1:
+        selected[np.argpartition(costs, n_slots - 1)[:n_slots]] = True
+        return selected
+    selected = min_run_slots(costs, n_slots, min(min_run, n_slots))
+    if not selected.any():
+        # the available slots are too fragmented for the minimum run length
+        return cheapest_slots(costs, n_slots)
+    return selected
+
+
+def min_run_slots(costs, n_slots:int, min_run:int):
+    # Dynamic programme over (slots taken, current run length capped at min_run), vectorised over slots taken.
+    # run state 0 means the relay is off, min_run means the current run is long enough to be stopped.
+    n = len(costs)
+    best = np.full((n + 1, n_slots + 1, min_run + 1), np.inf)
+    best[0, 0, 0] = 0.0
+
+    for i, cost in enumerate(costs):
+        prev, cur = best[i], best[i + 1]
+        cur[:, 0] = np.minimum(prev[:, 0], prev[:, min_run])
+        cur[1:, 1:min_run] = prev[:-1, 0:min_run - 1] + cost
+        cur[1:, min_run] = np.minimum(prev[:-1, min_run - 1], prev[:-1, min_run]) + cost
+
+    selected = np.zeros(n, dtype=bool)
+    taken, run = n_slots, (0 if best[n, n_slots, 0] <= best[n, n_slots, min_run] else min_run)
+    if not np.isfinite(best[n, taken, run]):
+        return selected
+
+    for i in range(n, 0, -1):
+        prev = best[i - 1]
+        if run == 0:
+            run = 0 if prev[taken, 0] <= prev[taken, min_run] else min_run
+            continue
+        selected[i - 1] = True
+        taken -= 1
+        if run < min_run:
+            run -= 1
+        else:
+            run = min_run - 1 if prev[taken, min_run - 1] <= prev[taken, min_run] else min_run
+
+    return selected
+
+
+def plan_batch(prices, n_slots, available=None, min_run:int=1):
+    # plans many sessions at once: prices and available are (sessions x slots), n_slots has one count per session
+    costs = np.asarray(prices, dtype=np.float64).copy()
+    if available is not None:
+        costs[~np.asarray(available, dtype=bool)] = np.inf
+    n_slots = np.minimum(np.asarray(n_slots), np.isfinite(costs).sum(axis=1))
+
+    if min_run > 1:
+        return np.array([cheapest_slots(row, n, min_run=min_run) for row, n in zip(costs, n_slots)]).reshape(costs.shape)
+
+    ranks = np.empty_like(costs, dtype=np.int64)
+    order = np.argsort(costs, axis=1, kind="stable")
+    np.put_along_axis(ranks, order, np.arange(costs.shape[1])[None, :], axis=1)
+    return ranks < n_slots[:, None]
+
+
+def mask_to_intervals(timestamps, selected, slot_seconds:int=SLOT_SECONDS):
+    # merges consecutive selected slots into (start, end) epoch intervals
+    timestamps = np.asarray(timestamps, dtype=np.int64)[np.asarray(selected, dtype=bool)]
+    if len(timestamps) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(timestamps) != slot_seconds) + 1
+    starts = timestamps[np.r_[0, breaks]]
+    ends = timestamps[np.r_[breaks - 1, len(timestamps) - 1]] + slot_seconds
+    return list(zip(starts.tolist(), ends.tolist()))
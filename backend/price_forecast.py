@@ -0,0 +1,176 @@
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+from .price_providers import fetch_slot_prices
+from .config import FORECAST_HISTORY_DAYS, FORECAST_RIDGE_ALPHA
+
+
+HOUR = 3600
+HORIZON_HOURS = 48 # trained horizons: day-ahead publication leaves at most about a day and a half unknown
+MIN_RIDGE_DAYS = 8 # a week of lags plus one day to fit on, below that the forecast is seasonal naive
+Z_80 = 1.2816 # half width of a two-sided 80% interval in residual standard deviations
+
+
+def hourly_series(rows):
+    # (datetime, price) rows at any resolution to hourly means on a gap-free grid: (first hour epoch, prices with NaN)
+    if not rows:
+        return 0, np.empty(0)
+    hours = np.array([int(dt.timestamp()) for dt, _ in rows], dtype=np.int64) // HOUR
+    prices = np.array([price for _, price in rows], dtype=np.float64)
+    first = int(hours.min())
+    n = int(hours.max()) - first + 1
+    sums = np.bincount(hours - first, weights=prices, minlength=n)
+    counts = np.bincount(hours - first, minlength=n)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return first * HOUR, sums / counts
+
+
+def trailing_mean(series, window:int=24):
+    # mean of the known values among the `window` hours ending at each index
+    values = np.nan_to_num(series)
+    known = (~np.isnan(series)).astype(np.float64)
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    counts = np.concatenate(([0.0], np.cumsum(known)))
+    ends = np.arange(1, len(series) + 1)
+    starts = np.maximum(0, ends - window)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (sums[ends] - sums[starts]) / (counts[ends] - counts[starts])
+
+
+def residual_sigma(residuals, days_ahead, days:int=HORIZON_HOURS // 24):
+    # standard deviation of the residuals for each day ahead, the overall one where a day has none
+    usable = ~np.isnan(residuals)
+    overall = residuals[usable].std() if usable.any() else 0.0
+    return np.array([
+        residuals[usable & (days_ahead == day)].std() if (usable & (days_ahead == day)).any() else overall
+        for day in range(days)
+    ])
+
+
+@dataclass
+class ForecastModel:
+    weights: np.ndarray # ridge weights, None for the seasonal naive fallback
+    sigma: np.ndarray # residual standard deviation for the 1st, 2nd, ... day ahead
+
+
+class PriceForecaster():
+    # Fills hours without a published price. Every target hour is described by what is known at the forecast
+    # origin (the last published hour): the price at the same local hour on the latest known day and in the
+    # latest known week, the level of the last 24 hours, and hour-of-day and weekend indicators. A ridge
+    # regression over the last history_days of the price store maps them to a price, fitted in closed form
+    # on origins at the same hour of every past day, so a fit over weeks of history takes milliseconds.
+    def __init__(self, history_days:int=28, alpha:float=1.0, tz:str="Europe/Madrid"):
+        self.history_days = history_days
+        self.alpha = alpha
+        self.tz = tz
+        self.models = {} # provider key -> (origin epoch, ForecastModel), refitted when a new hour is published
+
+    def features(self, series, first:int, targets, origins):
+        # (X, naive): one row per target, NaN where a lag reaches before the history; naive is the seasonal naive forecast
+        ahead = targets - origins
+        day_lag = targets - 24 * ((ahead + 23) // 24)
+        week_lag = targets - 168 * ((ahead + 167) // 168)
+        naive = np.where(day_lag >= 0, series[np.maximum(day_lag, 0)], np.nan)
+        weekly = np.where(week_lag >= 0, series[np.maximum(week_lag, 0)], np.nan)
+
+        local = pd.to_datetime(first + targets * HOUR, unit="s", utc=True).tz_convert(self.tz)
+        hour_of_day = np.eye(24)[local.hour.to_numpy()]
+        weekend = (local.dayofweek.to_numpy() >= 5).astype(np.float64)
+        level = trailing_mean(series)[origins]
+
+        X = np.column_stack((np.ones(len(targets)), naive, weekly, level, weekend, hour_of_day))
+        return X, naive
+
+    def fit(self, series, first:int, origin:int) -> ForecastModel:
+        # training origins: the same hour as origin on every earlier day, targets up to HORIZON_HOURS after each
+        origins = np.arange(origin - 24, -1, -24)
+        targets = origins[:, None] + np.arange(1, HORIZON_HOURS + 1)[None, :]
+        origins = np.broadcast_to(origins[:, None], targets.shape).ravel()
+        targets = targets.ravel()
+        inside = targets <= origin
+        origins, targets = origins[inside], targets[inside]
+        days_ahead = (targets - origins - 1) // 24
+
+        X, naive = self.features(series, first, targets, origins)
+        y = series[targets]
+        valid = ~np.isnan(X).any(axis=1) & ~np.isnan(y)
+
+        if origin + 1 < MIN_RIDGE_DAYS * 24 or valid.sum() < 10 * X.shape[1]:
+            return ForecastModel(None, residual_sigma(y - naive, days_ahead))
+
+        X, y, days_ahead = X[valid], y[valid], days_ahead[valid]
+        penalty = self.alpha * np.eye(X.shape[1])
+        penalty[0, 0] = 0.0 # the intercept is not shrunk
+        weights = np.linalg.solve(X.T @ X + penalty, X.T @ y)
+        return ForecastModel(weights, residual_sigma(y - X @ weights, days_ahead))
+
+    def predict(self, model:ForecastModel, series, first:int, origin:int, targets):
+        X, naive = self.features(series, first, targets, np.full(len(targets), origin))
+        price = naive if model.weights is None else X @ model.weights
+        price = np.where(np.isnan(price), naive, price) # rows missing the weekly lag fall back to seasonal naive
+        # beyond the trained days ahead the uncertainty keeps growing with the square root of the days ahead
+        days_ahead = (targets - origin - 1) // 24
+        sigma = model.sigma[np.minimum(days_ahead, len(model.sigma) - 1)] * np.sqrt(np.maximum(1.0, (days_ahead + 1) / len(model.sigma)))
+        return price, price - Z_80 * sigma, price + Z_80 * sigma
+
+    async def forecast(self, provider, end:datetime):
+        # hourly (epochs, price, lower, upper) from the hour after the last published price up to end
+        start_hour = int(time.time()) // HOUR - self.history_days * 24
+        rows = await provider.get_range(datetime.fromtimestamp(start_hour * HOUR, timezone.utc), end)
+        first, series = hourly_series(rows)
+        known = np.flatnonzero(~np.isnan(series))
+        if len(known) < 24:
+            return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0), np.empty(0)
+
+        origin = int(known[-1])
+        cached = self.models.get(provider.key)
+        if cached is None or cached[0] != first + origin * HOUR:
+            cached = (first + origin * HOUR, self.fit(series, first, origin))
+            self.models[provider.key] = cached
+        model = cached[1]
+
+        end_hour = (int(end.timestamp()) + HOUR - 1) // HOUR
+        targets = np.arange(origin + 1, end_hour - first // HOUR, dtype=np.int64)
+        series = np.concatenate((series[:origin + 1], np.full(len(targets), np.nan)))
+        price, lower, upper = self.predict(model, series, first, origin, targets)
+        return first + targets * HOUR, price, lower, upper
+
+
+price_forecaster = PriceForecaster(FORECAST_HISTORY_DAYS, FORECAST_RIDGE_ALPHA)
+
+
+async def forecast_slot_prices(providers, start:datetime, end:datetime):
+    # fetch_slot_prices with the unpublished slots filled from the forecast. Returns the grid, the price
+    # matrix, lower and upper bounds (equal to the price where it is published) and which slots are forecasts.
+    grid, prices = await fetch_slot_prices(providers, start, end)
+    lower, upper = prices.copy(), prices.copy()
+    forecasted = np.zeros(prices.shape, dtype=bool)
+    if not FORECAST_HISTORY_DAYS or not np.isnan(prices).any():
+        return grid, prices, lower, upper, forecasted
+
+    forecasts = {}
+    for row, provider in enumerate(providers):
+        missing = np.isnan(prices[row])
+        if not missing.any():
+            continue
+        if provider.key not in forecasts:
+            try:
+                forecasts[provider.key] = await price_forecaster.forecast(provider, end)
+            except Exception as err:
+                print(f"Price forecast for {provider.key} failed, unpublished slots stay unpriced: {err}")
+                forecasts[provider.key] = None
+        if forecasts[provider.key] is None or len(forecasts[provider.key][0]) == 0:
+            continue
+
+        hours, price, low, high = forecasts[provider.key]
+        idx = (grid // HOUR - hours[0] // HOUR).astype(np.int64)
+        fill = missing & (idx >= 0) & (idx < len(hours))
+        fill[fill] &= ~np.isnan(price[idx[fill]])
+        prices[row, fill] = price[idx[fill]]
+        lower[row, fill] = low[idx[fill]]
+        upper[row, fill] = high[idx[fill]]
+        forecasted[row] = fill
+
+    return grid, prices, lower, upper, forecasted
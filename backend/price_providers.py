@@ -0,0 +1,203 @@
+import asyncio
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pandas as pd
+from .mappings import Area, lookup_area
+from .entsoe_parser import parse_entsoe_da
+from .planner import SLOT_SECONDS, expand_to_slots
+from .http_client import get_with_retries, split_days
+from .price_store import price_store, to_epoch
+from .config import ENTSOE_API_KEY, ESIOS_API_KEY, PRICE_SOURCE, DEVICE_PRICE_SOURCES
+
+
+PVPC_SOURCE = "esios:1001"
+PVPC_GEO_NAME = "Península"
+ENTSOE_DA_SOURCE = "entsoe:A44"
+
+
+async def download_entsoe_DA(start_str_date, end_str_date, code):
+
+    ENTSOE_URL = "https://web-api.tp.entsoe.eu/api"
+
+    params = {
+        'documentType': 'A44',
+        'periodStart': start_str_date,
+        'periodEnd': end_str_date,
+        'out_Domain': code,
+        'in_Domain': code,
+        'contract_MarketAgreement.type': 'A01',
+        'securityToken': ENTSOE_API_KEY
+    }
+
+    response = await get_with_retries(ENTSOE_URL, params=params)
+
+    start_dt = datetime.strptime(start_str_date, "%Y%m%d%H%M")
+    end_dt = datetime.strptime(end_str_date, "%Y%m%d%H%M")
+    timestamps, prices = parse_entsoe_da(response.content, start_dt, end_dt)
+
+    return timestamps, prices
+
+
+async def download_pvpc(start_dt, end_dt):
+    # downloads PVPC hourly values for the half-open UTC range [start_dt, end_dt), one concurrent request per day
+
+    days = await asyncio.gather(*[download_pvpc_day(day_start, day_end) for day_start, day_end in split_days(start_dt, end_dt)])
+
+    return [row for day in days for row in day]
+
+
+async def download_pvpc_day(start_dt, end_dt):
+
+    pvpc_url = "https://api.esios.ree.es/indicators/1001"
+
+    # params for request (ESIOS end_date is inclusive)
+    params = {"start_date":start_dt,
+              "end_date":end_dt - timedelta(hours=1)}
+
+    headers = {
+    "Accept": "application/json; application/vnd.esios-api-v1+json",
+    "Content-Type": "application/json",
+    "x-api-key": ESIOS_API_KEY,
+    }
+
+    response_pvpc = await get_with_retries(pvpc_url, params=params, headers=headers)
+    content = response_pvpc.json()
+    pvpc_hour_values = [(_dict['datetime_utc'],_dict['value']) for _dict in content['indicator']['values'] if _dict['geo_name']==PVPC_GEO_NAME]
+
+    return pvpc_hour_values
+
+
+class PriceProvider(ABC):
+    # A market price source. get_range() returns the published (utc datetime, price) rows of a half-open range,
+    # read through the price store at the provider's native resolution; slot_prices() normalises them to
+    # SLOT_SECONDS arrays, the resolution the planner works in.
+    source = None
+    step = 3600
+
+    def __init__(self, area:str):
+        self.area = area
+
+    @property
+    def key(self) -> str:
+        return f"{self.source}/{self.area}"
+
+    @abstractmethod
+    async def download(self, start:datetime, end:datetime):
+        # (timestamp, price) pairs of the half-open range, straight from the source
+        ...
+
+    async def get_range(self, start:datetime, end:datetime):
+        start = datetime.fromtimestamp(to_epoch(start) // self.step * self.step, timezone.utc)
+        return await price_store.get_range(self.source, self.area, start, end, self.step, self.download)
+
+    async def slot_prices(self, start:datetime, end:datetime):
+        rows = await self.get_range(start, end)
+        return expand_to_slots([int(dt.timestamp()) for dt, _ in rows], [price for _, price in rows], self.step)
+
+
+class EsiosPvpcProvider(PriceProvider):
+    # Spanish regulated tariff (ESIOS indicator 1001), hourly
+    source = PVPC_SOURCE
+    step = 3600
+
+    def __init__(self, geo_name:str=PVPC_GEO_NAME):
+        super().__init__(geo_name)
+
+    async def download(self, start:datetime, end:datetime):
+        return await download_pvpc(start, end)
+
+
+class EntsoeDayAheadProvider(PriceProvider):
+    # ENTSO-E day-ahead auction (A44) of any bidding zone in mappings.Area, at 15 minute resolution
+    source = ENTSOE_DA_SOURCE
+    step = SLOT_SECONDS
+
+    def __init__(self, area):
+        self.bidding_zone = lookup_area(area)
+        super().__init__(self.bidding_zone.code)
+
+    async def download(self, start:datetime, end:datetime):
+        days = await asyncio.gather(*[
+            download_entsoe_DA(day_start.strftime("%Y%m%d%H%M"), day_end.strftime("%Y%m%d%H%M"), self.area)
+            for day_start, day_end in split_days(start, end)
+        ])
+        return [
+            (epoch, price)
+            for timestamps, prices in days
+            for epoch, price in zip(timestamps.astype("datetime64[s]").astype(np.int64).tolist(), prices.tolist())
+        ]
+
+
+class FilePriceProvider(PriceProvider):
+    # Offline prices from a CSV or Parquet file with a timestamp column (UTC unless it carries an offset) and a
+    # price column. The file is read once and served from memory, the price store is not involved.
+    source = "file"
+
+    def __init__(self, path:str):
+        super().__init__(path)
+        self.path = path
+        self.epochs = None
+        self.prices = None
+
+    def load(self):
+        if self.epochs is None:
+            frame = pd.read_parquet(self.path) if self.path.endswith(".parquet") else pd.read_csv(self.path)
+            timestamps = pd.to_datetime(frame["timestamp"], utc=True)
+            order = np.argsort(timestamps.values)
+            self.epochs = (timestamps.values[order].astype("datetime64[s]").astype(np.int64))
+            self.prices = frame["price"].to_numpy(dtype=np.float64)[order]
+            steps = np.diff(self.epochs)
+            self.step = int(np.median(steps)) if len(steps) else 3600
+        return self.epochs, self.prices
+
+    async def download(self, start:datetime, end:datetime):
+        epochs, prices = await asyncio.to_thread(self.load)
+        lo, hi = np.searchsorted(epochs, [to_epoch(start) // self.step * self.step, to_epoch(end)])
+        return list(zip(epochs[lo:hi].tolist(), prices[lo:hi].tolist()))
+
+    async def get_range(self, start:datetime, end:datetime):
+        return [(datetime.fromtimestamp(epoch, timezone.utc), price) for epoch, price in await self.download(start, end)]
+
+
+def provider_from_spec(spec:str) -> PriceProvider:
+    # "esios", "esios:<geo name>", "entsoe:<Area name or EIC code>" or "file:<path to .csv/.parquet>"
+    kind, _, arg = spec.partition(":")
+    if kind == "esios":
+        return EsiosPvpcProvider(arg or PVPC_GEO_NAME)
+    if kind == "entsoe":
+        return EntsoeDayAheadProvider(arg or Area.ES)
+    if kind == "file":
+        return FilePriceProvider(arg)
+    raise ValueError(f"Unknown price source {spec}, expected esios, entsoe:<area> or file:<path>")
+
+
+_providers = {}
+
+
+def provider_for(device_id:str=None) -> PriceProvider:
+    # the price source configured for a device (DEVICE_PRICE_SOURCES), PRICE_SOURCE otherwise; one instance per spec
+    spec = DEVICE_PRICE_SOURCES.get(device_id, PRICE_SOURCE)
+    if spec not in _providers:
+        _providers[spec] = provider_from_spec(spec)
+    return _providers[spec]
+
+
+async def fetch_slot_prices(providers, start:datetime, end:datetime):
+    # Prices of several markets on one common SLOT_SECONDS grid covering [start, end): returns the grid
+    # and a (providers x slots) matrix, NaN where a market has no published price. Each distinct market
+    # is fetched once and all of them concurrently.
+    unique = {provider.key: provider for provider in providers}
+    results = await asyncio.gather(*[provider.slot_prices(start, end) for provider in unique.values()])
+    by_key = dict(zip(unique, results))
+
+    first = to_epoch(start) // SLOT_SECONDS * SLOT_SECONDS
+    grid = np.arange(first, to_epoch(end), SLOT_SECONDS, dtype=np.int64)
+    matrix = np.full((len(providers), len(grid)), np.nan)
+    for row, provider in enumerate(providers):
+        timestamps, prices = by_key[provider.key]
+        idx = (timestamps - first) // SLOT_SECONDS
+        inside = (idx >= 0) & (idx < len(grid))
+        matrix[row, idx[inside]] = prices[inside]
+
+    return grid, matrix
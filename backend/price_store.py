@@ -0,0 +1,164 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from .db import async_pool
+from .metrics import registry, async_pooled_connection, PRICE_SLOTS
+from .config import PRICE_CACHE_SIZE, PRICE_MISSING_TTL
+
+
+CREATE_PRICES_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS market_prices (
+        source TEXT NOT NULL,
+        area TEXT NOT NULL,
+        timestamp TIMESTAMPTZ NOT NULL,
+        price DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (source, area, timestamp)
+    );
+"""
+
+SELECT_PRICES_SQL = """
+    SELECT timestamp, price
+    FROM market_prices
+    WHERE source = %s AND area = %s AND timestamp >= %s AND timestamp < %s
+"""
+
+UPSERT_PRICE_SQL = """
+    INSERT INTO market_prices (source, area, timestamp, price)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (source, area, timestamp) DO UPDATE SET price = EXCLUDED.price
+"""
+
+
+def create_prices_table(cur):
+    cur.execute(CREATE_PRICES_TABLE_SQL)
+
+
+def to_epoch(ts) -> int:
+    if isinstance(ts, int):
+        return ts
+    if isinstance(ts, str):
+        ts = datetime.fromisoformat(ts.replace("Z", "+00:00"))
+    return int(ts.timestamp())
+
+
+class PriceStore():
+    # Published day-ahead prices never change, so every slot fetched once is kept in an in-process LRU
+    # backed by the market_prices table. Only slots found in neither are requested upstream, and slots
+    # upstream could not provide yet (not published) are remembered for missing_ttl seconds.
+    def __init__(self, max_entries:int=200000, missing_ttl:float=900):
+        self.max_entries = max_entries
+        self.missing_ttl = missing_ttl
+
+        self._cache = OrderedDict() # (source, area, epoch) -> price
+        self._missing = {} # (source, area, epoch) -> monotonic expiry
+        self._lock = threading.Lock()
+
+    async def get_range(self, source:str, area:str, start:datetime, end:datetime, step:int, fetch):
+        # Prices for the half-open range [start, end) at `step` seconds resolution, as (utc datetime, price).
+        # await fetch(start, end) downloads a half-open range and returns (timestamp, price) pairs.
+        slots = range(to_epoch(start), to_epoch(end), step)
+
+        missing = self._lookup_missing(source, area, slots)
+        PRICE_SLOTS.inc(source, "cache", amount=len(slots) - len(missing))
+        if missing:
+            await self._load_from_db(source, area, missing[0], missing[-1] + step)
+            loaded = len(missing)
+            missing = self._lookup_missing(source, area, missing)
+            PRICE_SLOTS.inc(source, "db", amount=loaded - len(missing))
+
+        if missing:
+            first = datetime.fromtimestamp(missing[0], timezone.utc)
+            last = datetime.fromtimestamp(missing[-1] + step, timezone.utc)
+            rows = [(to_epoch(ts), float(price)) for ts, price in await fetch(first, last)]
+            await self._store(source, area, rows)
+
+            expiry = time.monotonic() + self.missing_ttl
+            unavailable = 0
+            with self._lock:
+                for epoch in missing:
+                    if (source, area, epoch) not in self._cache:
+                        self._missing[(source, area, epoch)] = expiry
+                        unavailable += 1
+            PRICE_SLOTS.inc(source, "upstream", amount=len(missing) - unavailable)
+            PRICE_SLOTS.inc(source, "unavailable", amount=unavailable)
+
+        result = []
+        with self._lock:
+            for epoch in slots:
+                key = (source, area, epoch)
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    result.append((datetime.fromtimestamp(epoch, timezone.utc), self._cache[key]))
+        return result
+
+    def _lookup_missing(self, source, area, slots):
+        now = time.monotonic()
+        missing = []
+        with self._lock:
+            for epoch in slots:
+                key = (source, area, epoch)
+                if key in self._cache:
+                    continue
+                expiry = self._missing.get(key)
+                if expiry is not None:
+                    if expiry > now:
+                        continue
+                    del self._missing[key]
+                missing.append(epoch)
+        return missing
+
+    def _remember(self, source, area, rows):
+        with self._lock:
+            for epoch, price in rows:
+                key = (source, area, epoch)
+                self._cache[key] = price
+                self._cache.move_to_end(key)
+                self._missing.pop(key, None)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    async def _load_from_db(self, source, area, start_epoch, end_epoch):
+        try:
+            async with async_pooled_connection(async_pool, "price_store") as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(SELECT_PRICES_SQL, (
+                        source, area,
+                        datetime.fromtimestamp(start_epoch, timezone.utc),
+                        datetime.fromtimestamp(end_epoch, timezone.utc)
+                    ), prepare=True)
+                    rows = await cur.fetchall()
+        except Exception as err:
+            print(f"Price store unavailable, fetching upstream: {err}")
+            return
+        self._remember(source, area, [(to_epoch(ts), price) for ts, price in rows])
+
+    async def _store(self, source, area, rows):
+        if not rows:
+            return
+        self._remember(source, area, rows)
+        try:
+            async with async_pooled_connection(async_pool, "price_store") as conn:
+                async with conn.cursor() as cur:
+                    await cur.executemany(UPSERT_PRICE_SQL, [
+                        (source, area, datetime.fromtimestamp(epoch, timezone.utc), price)
+                        for epoch, price in rows
+                    ])
+        except Exception as err:
+            print(f"Failed to persist {len(rows)} prices: {err}")
+
+
+price_store = PriceStore(max_entries=PRICE_CACHE_SIZE, missing_ttl=PRICE_MISSING_TTL)
+
+
+def cache_hit_ratio() -> dict:
+    # share of requested slots served without going upstream (in-process cache or market_prices)
+    totals = {}
+    for _, _, (source, origin), count in PRICE_SLOTS.samples():
+        hits, total = totals.get(source, (0.0, 0.0))
+        totals[source] = (hits + count * (origin in ("cache", "db")), total + count)
+    return {(source,): hits / total for source, (hits, total) in totals.items() if total}
+
+
+registry.gauge("price_cache_hit_ratio", "Share of price slots served from the cache or the database", ("source",), callback=cache_hit_ratio)
+registry.gauge("price_cache_entries", "Price slots held in the in-process cache", callback=lambda: {(): len(price_store._cache)})
@@ -0,0 +1,98 @@
+import threading
+import time
+import numpy as np
+from .metrics import registry
+from .config import RECENT_READINGS_SIZE
+
+
+class RingBuffer():
+    # The last `capacity` stored readings of one device in two preallocated arrays, the newest overwriting
+    # the oldest. Appended from the MQTT thread, read from the event loop.
+    def __init__(self, capacity:int):
+        self.capacity = capacity
+        self.epochs = np.zeros(capacity, dtype=np.float64)
+        self.power = np.zeros(capacity, dtype=np.float64)
+        self.count = 0 # readings appended so far, the next one goes to count % capacity
+        self.lock = threading.Lock()
+
+    def append(self, epoch:float, power:float):
+        with self.lock:
+            i = self.count % self.capacity
+            self.epochs[i] = epoch
+            self.power[i] = power
+            self.count += 1
+
+    @property
+    def wrapped(self) -> bool:
+        return self.count > self.capacity
+
+    def window(self, since:float):
+        # (covered_from, epochs, power): the readings from since on in time order, and the epoch from which
+        # the buffer still holds every reading (readings before it were overwritten), None if nothing was
+        with self.lock:
+            if self.wrapped:
+                start = self.count % self.capacity
+                epochs = np.concatenate((self.epochs[start:], self.epochs[:start]))
+                power = np.concatenate((self.power[start:], self.power[:start]))
+                covered_from = float(epochs[0])
+            else:
+                epochs = self.epochs[:self.count].copy()
+                power = self.power[:self.count].copy()
+                covered_from = None
+
+        order = np.argsort(epochs, kind="stable") # a held point can arrive out of order, usually a no-op
+        epochs, power = epochs[order], power[order]
+        keep = epochs > since
+        return covered_from, epochs[keep], power[keep]
+
+
+class RecentReadings():
+    # Per-device ring buffers of the readings stored since this process started, so recent power charts
+    # and WebSocket backfill are served from memory. Only what is older than the buffers needs the database.
+    def __init__(self, capacity:int=100000):
+        self.capacity = capacity
+        self.started = time.time()
+        self.buffers = {}
+        self._lock = threading.Lock()
+
+    def append(self, device_id:str, epoch:float, power:float):
+        buffer = self.buffers.get(device_id)
+        if buffer is None:
+            with self._lock:
+                buffer = self.buffers.setdefault(device_id, RingBuffer(self.capacity))
+        buffer.append(epoch, power)
+
+    def window(self, since:float, device_id:str=None):
+        # (covered_from, epochs, power) of one device, or of every device merged when device_id is None.
+        # Every reading newer than covered_from is in the arrays; older ones have to come from the database.
+        if device_id is not None:
+            buffers = [self.buffers[device_id]] if device_id in self.buffers else []
+        else:
+            buffers = list(self.buffers.values())
+
+        covered_from = self.started
+        parts = []
+        for buffer in buffers:
+            buffer_covered_from, epochs, power = buffer.window(since)
+            if buffer_covered_from is not None:
+                covered_from = max(covered_from, buffer_covered_from)
+            parts.append((epochs, power))
+
+        if not parts:
+            return covered_from, np.empty(0), np.empty(0)
+        epochs = np.concatenate([epochs for epochs, _ in parts])
+        power = np.concatenate([power for _, power in parts])
+        if len(parts) > 1:
+            order = np.argsort(epochs, kind="stable")
+            epochs, power = epochs[order], power[order]
+        # before covered_from some device's readings were already overwritten, that part is left to the database
+        keep = epochs >= covered_from
+        return covered_from, epochs[keep], power[keep]
+
+    def sizes(self) -> dict:
+        return {(device_id,): min(buffer.count, buffer.capacity) for device_id, buffer in list(self.buffers.items())}
+
+
+recent_readings = RecentReadings(RECENT_READINGS_SIZE)
+
+registry.gauge("recent_readings", "Power readings held in memory per device", ("device_id",), callback=recent_readings.sizes)
@@ -0,0 +1,131 @@
+import asyncio
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import numpy as np
+from .planner import SLOT_SECONDS, window_mask, plan_batch, mask_to_intervals
+from .scheduler import scheduler
+from .session_store import update_session_plan
+from .session_energy import session_meters
+from .price_providers import provider_for
+from .price_forecast import forecast_slot_prices
+from .config import MIN_RUN_SLOTS, REPLAN_INTERVAL_MINUTES
+
+
+def remaining_slots(intervals, start:float) -> int:
+    # quarter hours the plan still intends to charge from start on
+    seconds = sum(max(0.0, off.timestamp() - max(on.timestamp(), start)) for on, off in intervals)
+    return int(np.ceil(seconds / SLOT_SECONDS - 1e-9))
+
+
+def slots_still_needed(plan, start:float) -> int:
+    # what the session needs minus what its plan charges before start; plans without a stored requirement
+    # keep the size they have
+    if plan.required_slots is None:
+        return remaining_slots(plan.intervals, start)
+    charged = sum(max(0.0, min(off.timestamp(), start) - on.timestamp()) for on, off in plan.intervals)
+    return max(0, plan.required_slots - int(charged // SLOT_SECONDS))
+
+
+def kept_intervals(intervals, start:float, tz):
+    # what already happened (or is running) before start is left untouched
+    return [
+        (on, min(off, datetime.fromtimestamp(start, tz)))
+        for on, off in intervals if on.timestamp() < start
+    ]
+
+
+def plan_mask(timestamps, intervals):
+    timestamps = np.asarray(timestamps)
+    mask = np.zeros(len(timestamps), dtype=bool)
+    for on, off in intervals:
+        mask |= (timestamps >= on.timestamp()) & (timestamps < off.timestamp())
+    return mask
+
+
+def merge_intervals(intervals):
+    merged = []
+    for on, off in intervals:
+        if merged and merged[-1][1] >= on:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], off))
+        else:
+            merged.append((on, off))
+    return merged
+
+
+async def reoptimize_sessions(now:float=None) -> int:
+    # Re-plans the remaining part of every active session once prices beyond the horizon it was planned
+    # over have been published. The slot running now is kept, only slots from the next quarter hour on
+    # are chosen again (for all sessions in one batch, each against its device's market), and a session is
+    # only switched to the new plan when it covers more of the slots the session needs or is strictly cheaper.
+    # Returns the number of re-planned sessions.
+    plans = [plan for plan in list(scheduler.plans.values()) if not plan.cancelled]
+    now = time.time() if now is None else now
+    start = (int(now) // SLOT_SECONDS + 1) * SLOT_SECONDS
+    plans = [plan for plan in plans if plan.end_date.timestamp() > start]
+    if not plans:
+        return 0
+
+    spain_tz = ZoneInfo("Europe/Madrid")
+    timestamps, prices, _, _, forecasted = await forecast_slot_prices(
+        [provider_for(plan.controller.device_id) for plan in plans],
+        datetime.fromtimestamp(start, spain_tz),
+        max(plan.end_date for plan in plans)
+    )
+    # the horizon only moves with published prices, forecasts fill the rest of the window when re-planning
+    published = ~np.isnan(prices) & ~forecasted
+
+    candidates = []
+    for row, plan in enumerate(plans):
+        if not published[row].any():
+            continue
+        horizon = min(float(timestamps[published[row]][-1] + SLOT_SECONDS), plan.end_date.timestamp())
+        if plan.priced_until is None or horizon > plan.priced_until:
+            candidates.append((plan, row, horizon))
+            meter = session_meters.meters.get(plan.controller.device_id)
+            if meter is not None:
+                meter.set_prices(timestamps, np.where(published[row], prices[row], np.nan)) # newly published hours are metered at their price
+    if not candidates:
+        return 0
+
+    rows = [row for _, row, _ in candidates]
+    prices = prices[rows]
+    priced = ~np.isnan(prices)
+    available = np.array([window_mask(timestamps, start, plan.end_date.timestamp()) for plan, _, _ in candidates]) & priced
+    n_slots = np.array([slots_still_needed(plan, start) for plan, _, _ in candidates])
+    selected = plan_batch(np.where(priced, prices, np.inf), n_slots, available, MIN_RUN_SLOTS)
+
+    replanned = 0
+    for (plan, _, horizon), mask, window, row_prices in zip(candidates, selected, available, prices):
+        plan.priced_until = horizon
+        current = plan_mask(timestamps, plan.intervals) & window
+        # a plan charging more of what the session needs always wins, one of the same size only when cheaper
+        if mask.sum() < current.sum():
+            continue
+        if mask.sum() == current.sum() and row_prices[mask].sum() >= row_prices[current].sum() - 1e-9:
+            continue
+
+        intervals = merge_intervals(kept_intervals(plan.intervals, start, spain_tz) + [
+            (datetime.fromtimestamp(on, spain_tz), datetime.fromtimestamp(off, spain_tz))
+            for on, off in mask_to_intervals(timestamps, mask)
+        ])
+        device_id = plan.controller.device_id
+        if scheduler.replan(device_id, intervals):
+            print(f"Re-planned {device_id} with prices up to {datetime.fromtimestamp(horizon, spain_tz).isoformat()}:",
+                  [(on.isoformat(), off.isoformat()) for on, off in intervals])
+            if plan.session_id is not None:
+                await update_session_plan(plan.session_id, intervals)
+            replanned += 1
+
+    return replanned
+
+
+async def price_watch(interval_minutes:float=REPLAN_INTERVAL_MINUTES):
+    # day-ahead prices are published once a day (PVPC around 20:15), checking every few minutes is enough;
+    # unpublished hours are negative-cached by the price store, so idle polls do not hit the upstream API
+    while True:
+        try:
+            await reoptimize_sessions()
+        except Exception as err:
+            print(f"Re-optimisation failed: {err}")
+        await asyncio.sleep(interval_minutes * 60)
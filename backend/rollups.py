@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta, timezone
+
+
+BUCKET_SECONDS = 120
+
+CREATE_ROLLUP_2M_SQL = """
+    CREATE TABLE IF NOT EXISTS power_rollup_2m (
+        bucket TIMESTAMPTZ NOT NULL,
+        device_id TEXT NOT NULL,
+        power_sum DOUBLE PRECISION NOT NULL,
+        samples INT NOT NULL,
+        energy_wh DOUBLE PRECISION GENERATED ALWAYS AS (power_sum / samples * 120.0 / 3600.0) STORED,
+        PRIMARY KEY (bucket, device_id)
+    );
+"""
+
+CREATE_ROLLUP_1H_SQL = """
+    CREATE TABLE IF NOT EXISTS power_rollup_1h (
+        bucket TIMESTAMPTZ NOT NULL,
+        device_id TEXT NOT NULL,
+        energy_wh DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (bucket, device_id)
+    );
+"""
+
+UPSERT_ROLLUP_2M_SQL = """
+    INSERT INTO power_rollup_2m (bucket, device_id, power_sum, samples)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (bucket, device_id) DO UPDATE SET
+        power_sum = power_rollup_2m.power_sum + EXCLUDED.power_sum,
+        samples = power_rollup_2m.samples + EXCLUDED.samples
+"""
+
+# hourly energy is the sum of the 2-minute averages, so touched hours are recomputed from their 2-minute buckets
+REFRESH_ROLLUP_1H_SQL = """
+    INSERT INTO power_rollup_1h (bucket, device_id, energy_wh)
+    SELECT %(hour)s, %(device_id)s, COALESCE(SUM(energy_wh), 0)
+    FROM power_rollup_2m
+    WHERE device_id = %(device_id)s AND bucket >= %(hour)s AND bucket < %(hour)s + interval '1 hour'
+    ON CONFLICT (bucket, device_id) DO UPDATE SET energy_wh = EXCLUDED.energy_wh
+"""
+
+REBUILD_ROLLUP_2M_SQL = """
+    INSERT INTO power_rollup_2m (bucket, device_id, power_sum, samples)
+    SELECT
+        to_timestamp(floor(extract(epoch FROM timestamp) / 120) * 120) AS bucket,
+        device_id,
+        SUM(power),
+        COUNT(*)
+    FROM power_readings
+    WHERE timestamp >= %(start)s AND timestamp < %(end)s
+    GROUP BY 1, 2
+    ON CONFLICT (bucket, device_id) DO NOTHING
+"""
+
+REBUILD_ROLLUP_1H_SQL = """
+    INSERT INTO power_rollup_1h (bucket, device_id, energy_wh)
+    SELECT
+        to_timestamp(floor(extract(epoch FROM bucket) / 3600) * 3600) AS hour,
+        device_id,
+        SUM(energy_wh)
+    FROM power_rollup_2m
+    WHERE bucket >= %(start)s AND bucket < %(end)s
+    GROUP BY 1, 2
+    ON CONFLICT (bucket, device_id) DO UPDATE SET energy_wh = EXCLUDED.energy_wh
+"""
+
+
+def to_datetime(ts) -> datetime:
+    if isinstance(ts, str):
+        ts = datetime.fromisoformat(ts.replace("Z", "+00:00"))
+    return ts
+
+
+def floor_epoch(ts:datetime, seconds:int) -> datetime:
+    epoch = int(ts.timestamp()) // seconds * seconds
+    return datetime.fromtimestamp(epoch, timezone.utc)
+
+
+def create_rollup_tables(cur):
+    cur.execute(CREATE_ROLLUP_2M_SQL)
+    cur.execute(CREATE_ROLLUP_1H_SQL)
+
+
+def update_rollups(cur, batch):
+    # folds a batch of (timestamp, device_id, power) readings into the 2-minute and hourly rollups
+    buckets = {}
+    for timestamp, device_id, power in batch:
+        key = (floor_epoch(to_datetime(timestamp), BUCKET_SECONDS), device_id)
+        power_sum, samples = buckets.get(key, (0.0, 0))
+        buckets[key] = (power_sum + power, samples + 1)
+
+    cur.executemany(UPSERT_ROLLUP_2M_SQL, [
+        (bucket, device_id, power_sum, samples)
+        for (bucket, device_id), (power_sum, samples) in buckets.items()
+    ])
+
+    hours = {(floor_epoch(bucket, 3600), device_id) for bucket, device_id in buckets}
+    cur.executemany(REFRESH_ROLLUP_1H_SQL, [{"hour": hour, "device_id": device_id} for hour, device_id in hours])
+
+
+def rebuild_rollups(cur, start:datetime, end:datetime):
+    # fills 2-minute buckets missing from the rollup with raw readings between two hour boundaries, e.g. for history
+    # recorded before the rollups existed, and recomputes the hours. Existing buckets are kept: they were folded from
+    # every sample at ingest, while power_readings only holds the samples kept by the telemetry filter.
+    start, end = floor_epoch(start, 3600), floor_epoch(end + timedelta(seconds=3599), 3600)
+    cur.execute(REBUILD_ROLLUP_2M_SQL, {"start": start, "end": end})
+    cur.execute(REBUILD_ROLLUP_1H_SQL, {"start": start, "end": end})
+
+
+def backfill_rollups(cur):
+    # builds the rollups once for readings stored before they were maintained at ingest
+    cur.execute("SELECT EXISTS (SELECT 1 FROM power_rollup_1h)")
+    if cur.fetchone()[0]:
+        return
+    cur.execute("SELECT MIN(timestamp), MAX(timestamp) FROM power_readings")
+    start, end = cur.fetchone()
+    if start is not None:
+        print("Building energy rollups from stored power readings")
+        rebuild_rollups(cur, start, end + timedelta(seconds=1))
@@ -0,0 +1,243 @@
+import asyncio
+import heapq
+import itertools
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+from .mqtt_class import MQTTClass, SwitchTimeoutError, save_power_reading
+from .ingest import power_writer
+from .session_store import record_transition, finish_session, save_session_energy
+from .session_energy import session_meters
+from .price_providers import provider_for, fetch_slot_prices
+
+
+MAX_WAIT = 60 # re-check the heap at least once a minute in case the wall clock jumps
+
+
+@dataclass
+class SchedulePlan:
+    controller: MQTTClass
+    intervals: list
+    end_date: datetime
+    done: asyncio.Future
+    session_id: int = None # row in the sessions table, None when the plan is not persisted
+    version: int = 0 # bumped on every re-plan, transitions of older versions are skipped
+    priced_until: float = None # end of the price horizon the intervals were last optimised over
+    required_slots: int = None # quarter hours the session needs in total, None when unknown (e.g. older stored sessions)
+    cancelled: bool = False
+    charging: bool = False
+    finishing: bool = False # the final transition is being applied, nothing may interrupt it
+    apply_task: asyncio.Task = None
+
+
+@dataclass(order=True)
+class Transition:
+    when: float
+    seq: int
+    plan: SchedulePlan = field(compare=False)
+    state: bool = field(compare=False)
+    final: bool = field(compare=False, default=False)
+    version: int = field(compare=False, default=0)
+
+
+class ChargingScheduler():
+    # A single task on the event loop works through a heap of switch transitions for every session,
+    # so an active session costs a few heap entries instead of a worker thread.
+    def __init__(self, record_readings:bool=True):
+        # record_readings=False keeps the scheduler away from power_readings, for benchmarks
+        self.record_readings = record_readings
+        self.plans = {}
+
+        self._heap = []
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def schedule(self, controller: MQTTClass, intervals, end_date: datetime, session_id:int=None, required_slots:int=None) -> asyncio.Future:
+        # Transitions already in the past are not replayed: the first transition applies the state the plan
+        # wants right now, so scheduling a persisted plan again after a restart simply resumes it.
+        self.start()
+        self.cancel(controller.device_id)
+
+        plan = SchedulePlan(
+            controller=controller,
+            intervals=intervals,
+            end_date=end_date,
+            done=asyncio.get_running_loop().create_future(),
+            session_id=session_id,
+            required_slots=required_slots
+        )
+        self.plans[controller.device_id] = plan
+
+        self._push_plan(plan)
+        self._wakeup.set()
+        return plan.done
+
+    def replan(self, device_id:str, intervals) -> bool:
+        # swaps the intervals of a running plan in place: the session keeps its future and its end date,
+        # pending transitions of the old intervals are dropped lazily through the version check
+        plan = self.plans.get(device_id)
+        if plan is None or plan.cancelled or plan.finishing:
+            return False
+        plan.intervals = intervals
+        plan.version += 1
+        self._push_plan(plan, current_state=plan.charging)
+        self._wakeup.set()
+        return True
+
+    def _push_plan(self, plan:SchedulePlan, current_state:bool=None):
+        now = time.time()
+        if plan.end_date.timestamp() <= now:
+            # resumed after its end: only the final switch off, right away
+            self._push(now, plan, False, final=True)
+            return
+        # initial state (unless the relay is already in it), then one transition at every interval edge, then the final switch off
+        state = any(on.timestamp() <= now < off.timestamp() for on, off in plan.intervals)
+        if state != current_state:
+            self._push(now, plan, state)
+        for on, off in plan.intervals:
+            if on.timestamp() > now:
+                self._push(on.timestamp(), plan, True)
+            if off.timestamp() > now and off < plan.end_date:
+                self._push(off.timestamp(), plan, False)
+        self._push(plan.end_date.timestamp(), plan, False, final=True)
+
+    async def run_session(self, controller: MQTTClass, intervals, end_date: datetime, session_id:int=None, energy:dict=None, required_slots:int=None):
+        # energy: totals a resumed session had already metered before the restart
+        print("Charging intervals:", [(on.isoformat(), off.isoformat()) for on, off in intervals])
+        spain_time_now = datetime.now(ZoneInfo("Europe/Madrid"))
+
+        self._save_zero_reading(controller, spain_time_now)
+
+        meter = session_meters.start(controller.device_id, session_id, **(energy or {}))
+        done = self.schedule(controller, intervals, end_date, session_id, required_slots)
+        plan = self.plans[controller.device_id]
+        try:
+            # the relay is switched by the scheduler task meanwhile, prices only matter from the first sample on
+            await self._load_meter_prices(meter, controller.device_id, spain_time_now, end_date)
+            await asyncio.shield(done)
+        except asyncio.CancelledError:
+            if self.plans.get(controller.device_id) is plan:
+                self.cancel(controller.device_id)
+            raise
+        finally:
+            session_meters.stop(controller.device_id, meter)
+            totals = meter.totals()
+            print(f"Session of {controller.device_id} used {totals['energy_wh']:.0f} Wh for {totals['cost_eur']:.3f} EUR")
+            if session_id is not None:
+                await save_session_energy(session_id, totals)
+
+    async def _load_meter_prices(self, meter, device_id:str, start:datetime, end:datetime):
+        # usually served from the price store cache, the plan was just computed over the same range
+        try:
+            grid, prices = await fetch_slot_prices([provider_for(device_id)], start, end)
+            meter.set_prices(grid, prices[0])
+        except Exception as err:
+            print(f"No prices for the energy meter of {device_id}, its energy is counted as unpriced: {err}")
+
+    def cancel(self, device_id:str):
+        plan = self.plans.pop(device_id, None)
+        if plan is None:
+            return
+        # heap entries of a cancelled plan are skipped lazily when they come due
+        plan.cancelled = True
+        plan.charging = False
+        if plan.apply_task is not None:
+            plan.apply_task.cancel()
+        if not plan.done.done():
+            plan.done.cancel()
+
+    def _push(self, when:float, plan:SchedulePlan, state:bool, final:bool=False):
+        heapq.heappush(self._heap, Transition(when, next(self._seq), plan, state, final, plan.version))
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            while self._heap and self._heap[0].when <= now:
+                transition = heapq.heappop(self._heap)
+                plan = transition.plan
+                if plan.cancelled or plan.finishing or transition.version != plan.version:
+                    continue
+                if transition.final:
+                    plan.finishing = True
+                if plan.apply_task is not None:
+                    plan.apply_task.cancel()
+                plan.apply_task = asyncio.create_task(self._apply(transition))
+
+            timeout = MAX_WAIT if not self._heap else min(MAX_WAIT, max(0.0, self._heap[0].when - now))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _apply(self, transition: Transition):
+        plan = transition.plan
+        controller = plan.controller
+        try:
+            plan.charging = transition.state
+            await controller.switch(transition.state)
+            if plan.session_id is not None:
+                await record_transition(plan.session_id, transition.state)
+                meter = session_meters.session(plan.session_id)
+                if meter is not None:
+                    # checkpoint, so a restart loses at most the energy since the last switch
+                    await save_session_energy(plan.session_id, meter.totals())
+
+            if not transition.state:
+                # saving 0 power value when charging ends to ensure it is plotted correctly (if last value is for ex. 40W then it will leave that point as last which looks like charging didn't end)
+                self._save_zero_reading(controller, datetime.now(timezone.utc))
+
+            if transition.final:
+                if plan.session_id is not None:
+                    await finish_session(plan.session_id)
+                await self._flush_readings()
+                if self.plans.get(controller.device_id) is plan:
+                    del self.plans[controller.device_id]
+                if not plan.done.done():
+                    plan.done.set_result(controller)
+        except asyncio.CancelledError:
+            raise
+        except SwitchTimeoutError as err:
+            print(f"Charging session of {controller.device_id} failed: {err}")
+            await self._fail(plan, err)
+        except Exception as err:
+            print(f"Switch transition failed for {controller.device_id}: {err}")
+            if transition.final and not plan.done.done():
+                plan.done.set_exception(err)
+
+    def _save_zero_reading(self, controller:MQTTClass, when:datetime):
+        if self.record_readings:
+            save_power_reading(
+                device_id=controller.device_id,
+                power=0,
+                timestamp = when.astimezone(timezone.utc).isoformat()
+            )
+
+    async def _flush_readings(self):
+        if self.record_readings:
+            await asyncio.to_thread(power_writer.flush)
+
+    async def _fail(self, plan:SchedulePlan, err:Exception):
+        # an unreachable plug ends the session: the remaining transitions are dropped, the stored session is
+        # marked failed and the error is raised by run_session (not cancel(), which would cancel this task)
+        controller = plan.controller
+        if self.plans.get(controller.device_id) is plan:
+            del self.plans[controller.device_id]
+        plan.cancelled = True
+        plan.charging = False
+        controller.set_switch(False) # best effort, in case the plug comes back
+        if plan.session_id is not None:
+            await finish_session(plan.session_id, "failed")
+        await self._flush_readings()
+        if not plan.done.done():
+            plan.done.set_exception(err)
+
+
+scheduler = ChargingScheduler()
@@ -0,0 +1,60 @@
+import numpy as np
+import orjson
+from fastapi import Request, HTTPException, Response
+
+try:
+    import pyarrow as pa
+except ImportError: # Arrow output is optional
+    pa = None
+
+
+FORMATS = ("rows", "columnar", "binary", "arrow")
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+BINARY_MEDIA_TYPE = "application/octet-stream"
+
+
+def negotiate_format(request: Request, format: str = None) -> str:
+    # an explicit ?format= wins, otherwise the Accept header can ask for the binary variants
+    if format is not None:
+        if format not in FORMATS:
+            raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(FORMATS)}")
+        return format
+
+    accept = request.headers.get("accept", "")
+    if ARROW_MEDIA_TYPE in accept:
+        return "arrow"
+    if BINARY_MEDIA_TYPE in accept:
+        return "binary"
+    return "rows"
+
+
+def series_response(fmt: str, epochs, values, value_name: str) -> Response:
+    # Time series as parallel arrays instead of one object per point:
+    #   columnar: JSON {"timestamp": [epoch seconds], value_name: [floats]}
+    #   binary:   n little-endian int64 epoch seconds followed by n float32 values (n in X-Series-Length)
+    #   arrow:    Arrow IPC stream with timestamp[s, UTC] and float32 columns
+    epochs = np.asarray(epochs).astype("<i8")
+    values = np.asarray(values, dtype=np.float64)
+
+    if fmt == "columnar":
+        content = orjson.dumps({"timestamp": epochs, value_name: values}, option=orjson.OPT_SERIALIZE_NUMPY)
+        return Response(content=content, media_type="application/json")
+
+    if fmt == "binary":
+        content = epochs.tobytes() + values.astype("<f4").tobytes()
+        return Response(content=content, media_type=BINARY_MEDIA_TYPE, headers={"X-Series-Length": str(len(epochs))})
+
+    if fmt == "arrow":
+        if pa is None:
+            raise HTTPException(status_code=406, detail="Arrow output needs pyarrow installed")
+        table = pa.table({
+            "timestamp": pa.array(epochs, type=pa.timestamp("s", tz="UTC")),
+            value_name: pa.array(values.astype(np.float32)),
+        })
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return Response(content=sink.getvalue().to_pybytes(), media_type=ARROW_MEDIA_TYPE)
+
+    raise ValueError(f"Unsupported series format {fmt}")
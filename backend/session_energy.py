@@ -0,0 +1,102 @@
+import threading
+import numpy as np
+from .planner import SLOT_SECONDS
+
+
+class EnergyMeter():
+    # Running energy and cost of one charging session. Every power sample is integrated against the previous
+    # one with the trapezoidal rule as it arrives, and each piece is priced with the market price of the
+    # quarter hour it falls in (EUR/MWh, NaN or missing counts as unpriced energy).
+    def __init__(self, session_id:int=None, energy_wh:float=0.0, cost_eur:float=0.0, unpriced_wh:float=0.0):
+        self.session_id = session_id
+        self.energy_wh = energy_wh
+        self.cost_eur = cost_eur
+        self.unpriced_wh = unpriced_wh
+        self.samples = 0
+        self.last = None # previous (epoch, power)
+
+        self.price_start = 0
+        self.prices = np.empty(0)
+        self.lock = threading.Lock()
+
+    def set_prices(self, grid, prices):
+        # grid: SLOT_SECONDS epochs as returned by fetch_slot_prices, prices: one row of its matrix. Known
+        # prices are merged in, slots outside the new grid or unpublished in it keep their previous price.
+        if len(grid) == 0:
+            return
+        grid_start = int(grid[0])
+        with self.lock:
+            start = min(self.price_start, grid_start) if len(self.prices) else grid_start
+            end = max(self.price_start + len(self.prices) * SLOT_SECONDS, grid_start + len(grid) * SLOT_SECONDS)
+            merged = np.full((end - start) // SLOT_SECONDS, np.nan)
+            old = (self.price_start - start) // SLOT_SECONDS
+            merged[old:old + len(self.prices)] = self.prices
+            new = (grid_start - start) // SLOT_SECONDS
+            prices = np.asarray(prices, dtype=np.float64)
+            known = ~np.isnan(prices)
+            merged[new:new + len(prices)][known] = prices[known]
+            self.price_start, self.prices = start, merged
+
+    def price_at(self, epoch:float) -> float:
+        i = int((epoch - self.price_start) // SLOT_SECONDS)
+        return float(self.prices[i]) if 0 <= i < len(self.prices) else np.nan
+
+    def offer(self, epoch:float, power:float):
+        with self.lock:
+            if self.last is not None and epoch > self.last[0]:
+                self._integrate(*self.last, epoch, power)
+            self.last = (epoch, power)
+            self.samples += 1
+
+    def _integrate(self, t0:float, p0:float, t1:float, p1:float):
+        # split at quarter hour boundaries so a segment spanning two price slots is priced on both sides
+        slope = (p1 - p0) / (t1 - t0)
+        while t0 < t1:
+            t = min(t1, (t0 // SLOT_SECONDS + 1) * SLOT_SECONDS)
+            p = p0 + slope * (t - t0)
+            wh = (p0 + p) / 2 * (t - t0) / 3600
+            price = self.price_at(t0)
+            self.energy_wh += wh
+            if np.isnan(price):
+                self.unpriced_wh += wh
+            else:
+                self.cost_eur += wh / 1e6 * price # Wh -> MWh times EUR/MWh
+            t0, p0 = t, p
+
+    def totals(self) -> dict:
+        with self.lock:
+            return {
+                "energy_wh": self.energy_wh,
+                "cost_eur": self.cost_eur,
+                "unpriced_wh": self.unpriced_wh,
+            }
+
+
+class SessionMeters():
+    # device_id -> meter of its running session, fed from the MQTT thread with every raw sample
+    def __init__(self):
+        self.meters = {}
+
+    def start(self, device_id:str, session_id:int=None, energy_wh:float=0.0, cost_eur:float=0.0, unpriced_wh:float=0.0) -> EnergyMeter:
+        meter = EnergyMeter(session_id, energy_wh, cost_eur, unpriced_wh)
+        self.meters[device_id] = meter
+        return meter
+
+    def stop(self, device_id:str, meter:EnergyMeter):
+        # a newer session of the same device may already have replaced the meter
+        if self.meters.get(device_id) is meter:
+            del self.meters[device_id]
+
+    def offer(self, device_id:str, epoch:float, power:float):
+        meter = self.meters.get(device_id)
+        if meter is not None:
+            meter.offer(epoch, power)
+
+    def session(self, session_id:int) -> EnergyMeter:
+        for meter in list(self.meters.values()):
+            if meter.session_id == session_id:
+                return meter
+        return None
+
+
+session_meters = SessionMeters()
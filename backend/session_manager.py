@@ -1,9 +1,102 @@
+import asyncio
+import threading
 from typing import Optional
 from asyncio import Task
-from .mqtt_class import MQTTClass
+from .mqtt_class import MQTTClass, BrokerConnection
+from .scheduler import scheduler
+from .session_store import load_active_sessions, finish_session
+from .config import MQTT_SERVER, MQTT_PORT, SHELLY_IDS
 
 class ChargingSession:
     controller: Optional[MQTTClass] = None
     task: Optional[Task] = None
 
-session = ChargingSession()
\ No newline at end of file
+
+class DeviceRegistry:
+    # device_id -> controller/session, with one long-lived MQTT connection per broker for the whole application
+    def __init__(self, device_ids=()):
+        self.device_ids = list(device_ids)
+        self.connections = {}
+        self.controllers = {}
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def is_known(self, device_id:str) -> bool:
+        return device_id in self.device_ids or device_id in self.controllers
+
+    def connection(self, broker:str, port:int, loop) -> BrokerConnection:
+        key = (broker, port)
+        connection = self.connections.get(key)
+        if connection is None:
+            connection = BrokerConnection(broker, port, loop)
+            connection.connect()
+            self.connections[key] = connection
+        return connection
+
+    def controller(self, device_id:str, loop, broker:str=MQTT_SERVER, port:int=MQTT_PORT) -> MQTTClass:
+        with self._lock:
+            controller = self.controllers.get(device_id)
+            if controller is None:
+                connection = self.connection(broker, port, loop)
+                controller = MQTTClass(
+                    device_id=device_id,
+                    broker=broker,
+                    port=port,
+                    loop=loop,
+                    client=connection.client
+                )
+                connection.add_device(controller)
+                self.controllers[device_id] = controller
+            return controller
+
+    def start(self, loop):
+        # called from the lifespan: connects and subscribes every configured device up front, so starting a
+        # session finds its controller ready and online state already tracked
+        for device_id in self.device_ids:
+            self.controller(device_id, loop)
+
+    def close(self):
+        with self._lock:
+            for connection in self.connections.values():
+                connection.close()
+            self.connections.clear()
+            self.controllers.clear()
+
+    def readiness(self) -> dict:
+        brokers = [
+            {"broker": broker, "port": port, "connected": connection.connected}
+            for (broker, port), connection in list(self.connections.items())
+        ]
+        devices = {
+            device_id: {"online": controller.connected, "switch_on": controller.switch_on, "last_power": controller.last_power}
+            for device_id, controller in list(self.controllers.items())
+        }
+        return {"ready": bool(brokers) and all(broker["connected"] for broker in brokers), "brokers": brokers, "devices": devices}
+
+    def session(self, device_id:str) -> ChargingSession:
+        with self._lock:
+            if device_id not in self.sessions:
+                self.sessions[device_id] = ChargingSession()
+            return self.sessions[device_id]
+
+
+registry = DeviceRegistry(SHELLY_IDS)
+
+
+async def resume_sessions():
+    # Called at startup: every session still marked active in the database was interrupted by a restart.
+    # Its stored plan is scheduled again, which switches the relay to the state it should be in right now
+    # and continues with the remaining transitions (a plan whose end has passed is switched off and completed).
+    loop = asyncio.get_running_loop()
+    for session_id, device_id, intervals, end_charge, energy, required_slots in await load_active_sessions():
+        if not registry.is_known(device_id):
+            print(f"Not resuming session {session_id}: unknown device {device_id}")
+            await finish_session(session_id, "failed")
+            continue
+
+        print(f"Resuming charging session {session_id} of {device_id}")
+        controller = registry.controller(device_id, loop)
+        session = registry.session(device_id)
+        session.controller = controller
+        session.task = asyncio.create_task(scheduler.run_session(controller, intervals, end_charge, session_id, energy, required_slots))
+
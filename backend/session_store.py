@@ -0,0 +1,181 @@
+import json
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from .db import async_pool
+from .metrics import async_pooled_connection
+
+
+# sessions started by /api/save_session keep device_id, plan and status NULL, charging sessions fill them in
+MIGRATE_SESSIONS_SQL = [
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS session_id BIGSERIAL",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS device_id TEXT",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS plan JSONB",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS end_charge TIMESTAMPTZ",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS status TEXT",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS relay_state BOOLEAN",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS energy_wh DOUBLE PRECISION NOT NULL DEFAULT 0",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS cost_eur DOUBLE PRECISION NOT NULL DEFAULT 0",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS unpriced_wh DOUBLE PRECISION NOT NULL DEFAULT 0",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS required_slots INT",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_id ON sessions (session_id)",
+    "CREATE INDEX IF NOT EXISTS idx_sessions_active ON sessions (device_id) WHERE status = 'active'",
+]
+
+# a device has at most one active session, starting a new one supersedes the previous plan
+SUPERSEDE_SESSIONS_SQL = """
+    UPDATE sessions SET status = 'superseded', updated_at = NOW()
+    WHERE device_id = %s AND status = 'active'
+"""
+
+INSERT_SESSION_SQL = """
+    INSERT INTO sessions (start_charge_timestamp, pick_up_hour, pick_up_minute, soc, device_id, plan, end_charge, required_slots, status, updated_at)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'active', NOW())
+    RETURNING session_id
+"""
+
+# only writes when the state actually changes, so replaying a transition after a restart is a no-op
+RECORD_TRANSITION_SQL = """
+    UPDATE sessions SET relay_state = %(state)s, updated_at = NOW()
+    WHERE session_id = %(session_id)s AND status = 'active' AND relay_state IS DISTINCT FROM %(state)s
+"""
+
+UPDATE_PLAN_SQL = """
+    UPDATE sessions SET plan = %s, updated_at = NOW()
+    WHERE session_id = %s AND status = 'active'
+"""
+
+FINISH_SESSION_SQL = """
+    UPDATE sessions SET status = %(status)s, updated_at = NOW()
+    WHERE session_id = %(session_id)s AND status = 'active'
+"""
+
+CANCEL_DEVICE_SESSIONS_SQL = """
+    UPDATE sessions SET status = 'cancelled', updated_at = NOW()
+    WHERE device_id = %s AND status = 'active'
+"""
+
+# running totals of the session's energy meter, also written after the session ended
+SAVE_ENERGY_SQL = """
+    UPDATE sessions SET energy_wh = %(energy_wh)s, cost_eur = %(cost_eur)s, unpriced_wh = %(unpriced_wh)s, updated_at = NOW()
+    WHERE session_id = %(session_id)s
+"""
+
+SELECT_ACTIVE_SESSIONS_SQL = """
+    SELECT session_id, device_id, plan, end_charge, energy_wh, cost_eur, unpriced_wh, required_slots
+    FROM sessions
+    WHERE status = 'active'
+    ORDER BY start_charge_timestamp
+"""
+
+SELECT_SESSION_SQL = """
+    SELECT session_id, device_id, start_charge_timestamp, end_charge, status, relay_state,
+        energy_wh, cost_eur, unpriced_wh, updated_at
+    FROM sessions
+"""
+
+
+def migrate_sessions(cur):
+    for sql in MIGRATE_SESSIONS_SQL:
+        cur.execute(sql)
+
+
+def plan_to_json(intervals) -> str:
+    return json.dumps([{"start": on.isoformat(), "end": off.isoformat()} for on, off in intervals])
+
+
+def plan_from_json(plan, tz:str="Europe/Madrid"):
+    local_tz = ZoneInfo(tz)
+    return [
+        (datetime.fromisoformat(slot["start"]).astimezone(local_tz), datetime.fromisoformat(slot["end"]).astimezone(local_tz))
+        for slot in plan or []
+    ]
+
+
+async def create_session(device_id:str, start_charge_timestamp, hours:int, minutes:int, soc:int, intervals, end_charge:datetime, required_slots:int=None):
+    # stores the computed plan so it can be resumed after a restart, returns the session_id (None if the DB is down)
+    try:
+        async with async_pooled_connection(async_pool, "sessions") as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SUPERSEDE_SESSIONS_SQL, (device_id,))
+                await cur.execute(INSERT_SESSION_SQL, (
+                    start_charge_timestamp, hours, minutes, soc, device_id, plan_to_json(intervals), end_charge, required_slots
+                ))
+                return (await cur.fetchone())[0]
+    except Exception as err:
+        print(f"Could not persist charging session of {device_id}, it will not survive a restart: {err}")
+        return None
+
+
+async def record_transition(session_id:int, state:bool):
+    try:
+        async with async_pooled_connection(async_pool, "sessions") as conn:
+            await conn.execute(RECORD_TRANSITION_SQL, {"session_id": session_id, "state": state}, prepare=True)
+    except Exception as err:
+        print(f"Could not record relay state of session {session_id}: {err}")
+
+
+async def update_session_plan(session_id:int, intervals):
+    try:
+        async with async_pooled_connection(async_pool, "sessions") as conn:
+            await conn.execute(UPDATE_PLAN_SQL, (plan_to_json(intervals), session_id))
+    except Exception as err:
+        print(f"Could not store the new plan of session {session_id}: {err}")
+
+
+async def finish_session(session_id:int, status:str="completed"):
+    try:
+        async with async_pooled_connection(async_pool, "sessions") as conn:
+            await conn.execute(FINISH_SESSION_SQL, {"session_id": session_id, "status": status})
+    except Exception as err:
+        print(f"Could not mark session {session_id} {status}: {err}")
+
+
+async def cancel_device_sessions(device_id:str):
+    try:
+        async with async_pooled_connection(async_pool, "sessions") as conn:
+            await conn.execute(CANCEL_DEVICE_SESSIONS_SQL, (device_id,))
+    except Exception as err:
+        print(f"Could not cancel stored sessions of {device_id}: {err}")
+
+
+async def save_session_energy(session_id:int, totals:dict):
+    try:
+        async with async_pooled_connection(async_pool, "sessions") as conn:
+            await conn.execute(SAVE_ENERGY_SQL, {"session_id": session_id, **totals}, prepare=True)
+    except Exception as err:
+        print(f"Could not store the energy of session {session_id}: {err}")
+
+
+async def fetch_session_summary(session_id:int=None, device_id:str=None):
+    # one row by primary key, or the latest charging session of a device; None if there is none
+    async with async_pooled_connection(async_pool, "sessions") as conn:
+        async with conn.cursor() as cur:
+            if session_id is not None:
+                await cur.execute(SELECT_SESSION_SQL + "WHERE session_id = %(session_id)s", {"session_id": session_id})
+            else:
+                await cur.execute(
+                    SELECT_SESSION_SQL + "WHERE device_id = %(device_id)s ORDER BY session_id DESC LIMIT 1",
+                    {"device_id": device_id}
+                )
+            row = await cur.fetchone()
+            if row is None:
+                return None
+            return dict(zip([column.name for column in cur.description], row))
+
+
+async def load_active_sessions():
+    # (session_id, device_id, intervals, end_charge, energy totals, required slots) of every session that was running when the process stopped
+    async with async_pooled_connection(async_pool, "sessions") as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(SELECT_ACTIVE_SESSIONS_SQL)
+            rows = await cur.fetchall()
+
+    spain_tz = ZoneInfo("Europe/Madrid")
+    return [
+        (
+            session_id, device_id, plan_from_json(plan), end_charge.astimezone(spain_tz),
+            {"energy_wh": energy_wh, "cost_eur": cost_eur, "unpriced_wh": unpriced_wh}, required_slots
+        )
+        for session_id, device_id, plan, end_charge, energy_wh, cost_eur, unpriced_wh, required_slots in rows
+    ]
@@ -0,0 +1,175 @@
+import argparse
+import json
+import random
+import threading
+import time
+import paho.mqtt.client as mqtt
+
+
+PROFILES = ("constant", "cc-cv", "noisy", "sequence")
+
+
+class SimulatedPlug():
+    # A Shelly plug as seen by MQTTClass: answers status_update and on/off on <id>/command/switch:0,
+    # reports online on <id>/status and sends NotifyStatus power events on <id>/events/rpc while on.
+    def __init__(self, device_id:str, profile:str="cc-cv", power_w:float=2000, capacity_wh:float=8000,
+                 soc:float=20, switch_delay:float=0.2, failure_rate:float=0.0):
+        self.device_id = device_id
+        self.profile = profile
+        self.power_w = power_w
+        self.capacity_wh = capacity_wh
+        self.soc = soc
+        self.switch_delay = switch_delay
+        self.failure_rate = failure_rate
+
+        self.output = False
+        self.seq = 0
+        self.last_tick = None
+        self.sent = {} # power value -> publish time, used by the latency benchmark with the "sequence" profile
+
+    def power(self) -> float:
+        if not self.output:
+            return 0.0
+        if self.profile == "sequence":
+            self.seq += 1
+            return float(self.seq)
+        if self.profile == "noisy":
+            return max(0.0, random.gauss(self.power_w, self.power_w * 0.02))
+        if self.profile == "cc-cv" and self.soc >= 80:
+            # constant power up to 80 % then a linear taper down to 5 % of the rating
+            return self.power_w * max(0.05, (100 - self.soc) / 20)
+        return self.power_w
+
+    def advance(self, now:float, power:float):
+        if self.last_tick is not None:
+            self.soc = min(100.0, self.soc + power * (now - self.last_tick) / 3600 / self.capacity_wh * 100)
+        self.last_tick = now
+
+    def switch_status(self, power:float) -> dict:
+        return {"id": 0, "source": "MQTT", "output": self.output, "apower": power, "voltage": 230.0}
+
+    def notify_status(self, power:float, now:float) -> dict:
+        return {
+            "src": self.device_id,
+            "dst": f"{self.device_id}/events",
+            "method": "NotifyStatus",
+            "params": {"ts": now, "switch:0": {"id": 0, "apower": power}},
+        }
+
+
+class Simulator():
+    # Runs any number of simulated plugs on a single MQTT connection, publishing power events at `rate` Hz.
+    def __init__(self, plugs, broker:str="localhost", port:int=1883, rate:float=1.0):
+        self.plugs = {plug.device_id: plug for plug in plugs}
+        self.rate = rate
+        self.published = 0
+
+        self.client = mqtt.Client(client_id=f"shelly-simulator-{random.randint(0, 1 << 30)}")
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.broker = broker
+        self.port = port
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.client.connect(self.broker, self.port, 60)
+        self.client.loop_start()
+        self._thread = threading.Thread(target=self._run, name="shelly-simulator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def on_connect(self, client, userdata, flags, rc):
+        for device_id in self.plugs:
+            client.subscribe(f"{device_id}/command/#")
+
+    def on_message(self, client, userdata, msg):
+        device_id, _, command = msg.topic.partition("/command")
+        plug = self.plugs.get(device_id)
+        if plug is None:
+            return
+        payload = msg.payload.decode()
+
+        if command == "" and payload == "status_update":
+            self.publish(f"{device_id}/status", {"mqtt": {"connected": True}, "switch:0": plug.switch_status(plug.power())})
+        elif command == "/switch:0":
+            if payload in ("on", "off"):
+                if random.random() < plug.failure_rate:
+                    return # command lost, the backend has to retry
+                threading.Timer(plug.switch_delay, self._set_output, (plug, payload == "on")).start()
+            elif payload == "status_update":
+                self.publish(f"{device_id}/status/switch:0", plug.switch_status(plug.power()))
+
+    def _set_output(self, plug:SimulatedPlug, output:bool):
+        plug.output = output
+        self.publish(f"{plug.device_id}/status/switch:0", plug.switch_status(plug.power()))
+
+    def publish(self, topic:str, payload:dict):
+        self.client.publish(topic, json.dumps(payload))
+        self.published += 1
+
+    def _run(self):
+        interval = 1 / self.rate
+        next_tick = time.monotonic()
+        while not self._stop.is_set():
+            now = time.time()
+            for plug in list(self.plugs.values()):
+                if not plug.output:
+                    plug.advance(now, 0.0)
+                    continue
+                power = plug.power()
+                plug.advance(now, power)
+                plug.sent[power] = time.perf_counter()
+                self.publish(f"{plug.device_id}/events/rpc", plug.notify_status(power, now))
+
+            next_tick += interval
+            self._stop.wait(max(0.0, next_tick - time.monotonic()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated Shelly plugs publishing to an MQTT broker")
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--devices", type=int, default=1)
+    parser.add_argument("--prefix", default="shellysim")
+    parser.add_argument("--rate", type=float, default=1.0, help="power events per second and device")
+    parser.add_argument("--profile", choices=PROFILES, default="cc-cv")
+    parser.add_argument("--power", type=float, default=2000, help="charger power in W")
+    parser.add_argument("--switch-delay", type=float, default=0.2)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="probability of ignoring an on/off command")
+    parser.add_argument("--on", action="store_true", help="start with the relays on")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to run, forever by default")
+    args = parser.parse_args()
+
+    plugs = [
+        SimulatedPlug(f"{args.prefix}-{i}", profile=args.profile, power_w=args.power,
+                      switch_delay=args.switch_delay, failure_rate=args.failure_rate)
+        for i in range(args.devices)
+    ]
+    for plug in plugs:
+        plug.output = args.on
+
+    simulator = Simulator(plugs, args.broker, args.port, args.rate)
+    simulator.start()
+    print(f"Simulating {args.devices} plugs on {args.broker}:{args.port}, ids {args.prefix}-0..{args.devices - 1}")
+    try:
+        if args.duration is None:
+            while True:
+                time.sleep(60)
+        else:
+            time.sleep(args.duration)
+    except KeyboardInterrupt:
+        pass
+    simulator.stop()
+    print(f"Published {simulator.published} messages")
+
+
+if __name__ == "__main__":
+    main()
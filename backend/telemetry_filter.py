@@ -0,0 +1,76 @@
+class TelemetryFilter():
+    # Decides which power samples of one device are worth broadcasting and storing. offer() returns the
+    # (epoch, power) points to publish, in time order. A dropped sample is remembered as the held point and
+    # published right before the next kept one, so the stored series still shows exactly where a level ended
+    # and interpolating between stored points reproduces the signal within the threshold.
+    def __init__(self, max_silence:float=60.0):
+        self.max_silence = max_silence
+        self.last = None # last published (epoch, power)
+        self.held = None # last dropped (epoch, power) since then
+
+    def offer(self, power:float, epoch:float):
+        if self.last is None or epoch - self.last[0] >= self.max_silence or self.is_change(power, epoch):
+            points = [self.held, (epoch, power)] if self.held is not None else [(epoch, power)]
+            self.published(epoch, power)
+            return points
+
+        self.held = (epoch, power)
+        return []
+
+    def published(self, epoch:float, power:float):
+        self.last = (epoch, power)
+        self.held = None
+
+    def is_change(self, power:float, epoch:float) -> bool:
+        return True
+
+
+class DeadbandFilter(TelemetryFilter):
+    # keeps a sample once it moves more than deadband_w away from the last published value
+    def __init__(self, deadband_w:float=5.0, max_silence:float=60.0):
+        super().__init__(max_silence)
+        self.deadband_w = deadband_w
+
+    def is_change(self, power:float, epoch:float) -> bool:
+        return abs(power - self.last[1]) > self.deadband_w
+
+
+class SwingingDoorFilter(TelemetryFilter):
+    # Swinging-door compression: a sample is dropped while a straight line from the last published point
+    # still passes within compression_w of every sample since. Ramps (CV taper) compress to their end points.
+    def __init__(self, compression_w:float=10.0, max_silence:float=60.0):
+        super().__init__(max_silence)
+        self.compression_w = compression_w
+        self.upper = float("inf") # smallest slope allowed by the upper door so far
+        self.lower = float("-inf") # largest slope allowed by the lower door so far
+
+    def published(self, epoch:float, power:float):
+        super().published(epoch, power)
+        self.upper, self.lower = float("inf"), float("-inf")
+
+    def is_change(self, power:float, epoch:float) -> bool:
+        last_epoch, last_power = self.last
+        elapsed = epoch - last_epoch
+        if elapsed <= 0:
+            return abs(power - last_power) > self.compression_w
+
+        upper = min(self.upper, (power + self.compression_w - last_power) / elapsed)
+        lower = max(self.lower, (power - self.compression_w - last_power) / elapsed)
+        if lower > upper:
+            return True # doors opened, no single line fits every sample any more
+        self.upper, self.lower = upper, lower
+        return False
+
+
+FILTERS = {"deadband": DeadbandFilter, "swinging_door": SwingingDoorFilter}
+
+
+def make_filter(method:str, deadband_w:float=5.0, compression_w:float=10.0, max_silence:float=60.0):
+    # None means every sample is published
+    if method in (None, "", "off"):
+        return None
+    if method == "deadband":
+        return DeadbandFilter(deadband_w, max_silence)
+    if method == "swinging_door":
+        return SwingingDoorFilter(compression_w, max_silence)
+    raise ValueError(f"Unknown telemetry filter {method}, expected off or one of {', '.join(FILTERS)}")
@@ -1,19 +1,29 @@
+import time
 from datetime import datetime, timedelta, date, timezone
 from zoneinfo import ZoneInfo
 import numpy as np
 import pandas as pd
-import requests
-import xml.etree.ElementTree as ET
 from jose import jwt, JWTError
 from passlib.context import CryptContext
 from fastapi import Request, HTTPException
 from .mappings import lookup_area
-from .db import pool
+from .planner import charger_power_kw, slots_needed, energy_needed_kwh, window_mask, cheapest_slots, mask_to_intervals
+from .db import pool, async_pool
 import asyncio
 from .mqtt_class import MQTTClass
-from .config import ENTSOE_API_KEY,ESIOS_API_KEY, APP_USERNAME, JWT_SECRET
-
-
+from .price_store import price_store, create_prices_table
+from .price_providers import (
+    PVPC_SOURCE, PVPC_GEO_NAME, ENTSOE_DA_SOURCE, EntsoeDayAheadProvider, provider_for,
+    download_entsoe_DA, download_pvpc, download_pvpc_day,
+)
+from .price_forecast import forecast_slot_prices
+from .session_store import migrate_sessions, create_session
+from .metrics import async_pooled_connection, POWER_SERIES_READS
+from .recent_readings import recent_readings
+from .rollups import create_rollup_tables, backfill_rollups
+from .partitions import ensure_partitioned
+from .scheduler import scheduler
+from .config import APP_USERNAME, JWT_SECRET, BATTERY_CAPACITY_KWH, CHARGER_POWER_KW, MIN_RUN_SLOTS
 
 
 def bz_to_code(bz):
@@ -23,65 +33,24 @@ def bz_to_code(bz):
 
     return code
 
-def fetch_entsoe_DA(start_str_date, end_str_date, code):
-
-    ENTSOE_URL = "https://web-api.tp.entsoe.eu/api"
-
-    params = {
-        'documentType': 'A44',
-        'periodStart': start_str_date,
-        'periodEnd': end_str_date,
-        'out_Domain': code,
-        'in_Domain': code,
-        'contract_MarketAgreement.type': 'A01',
-        'securityToken': ENTSOE_API_KEY    
-    }
-
-    response = requests.get(ENTSOE_URL, params=params)
-    root = ET.fromstring(response.text) 
-
-    data = []
-    for ts in root.findall('.//{*}TimeSeries'):
+async def fetch_entsoe_DA(start_str_date, end_str_date, code):
 
-        day_data = []
-        for price,interval in zip(ts.findall('.//{*}price.amount'), ts.findall('.//{*}position')):
-
-            # Append all price and interval entries 
-            row = {
-                    "values": float(price.text),
-                    "interval": int(interval.text),
-                    }
-
-            day_data.append(row)
-
-        total_stamps = 24 if len(day_data) <24 else 96
-
-        values_column_title = 'DA'
-        prices_df = pd.DataFrame({values_column_title: [row['values'] for row in day_data],
-                                'interval': [row['interval'] for row in day_data]})
-        full_intervals = pd.DataFrame({'interval': range(1,(total_stamps+1))})
-        day_data_filled = full_intervals.merge(prices_df, on='interval', how='left')
-        day_data = day_data_filled[values_column_title].ffill() 
-
-        if total_stamps==24:    
-            day_data = [
-                {values_column_title: price}
-                for idx, price in enumerate(day_data)
-                for i in range(idx*4, idx*4 + 4)
-                ]
-        else:
-            day_data = [{values_column_title: v} for v in day_data]
+    utc = ZoneInfo("UTC")
+    start_dt = datetime.strptime(start_str_date, "%Y%m%d%H%M").replace(tzinfo=utc)
+    end_dt = datetime.strptime(end_str_date, "%Y%m%d%H%M").replace(tzinfo=utc)
+    if end_dt <= start_dt:
+        # same start and end asks ENTSO-E for the whole delivery day
+        end_dt = start_dt + timedelta(days=1)
 
-        data.extend(day_data)
+    rows = await EntsoeDayAheadProvider(code).get_range(start_dt, end_dt)
 
-    start_dt = datetime.strptime(start_str_date, "%Y%m%d%H%M")
-    data = pd.DataFrame(data)   
-    data["datetime"] = [start_dt + n*timedelta(minutes=15)  for n in range(len(data))]   
-    
-    return data
+    return pd.DataFrame({
+        "DA": [price for _, price in rows],
+        "datetime": [dt.replace(tzinfo=None) for dt, _ in rows],
+    })
 
 
-def get_prices_new(bz=str):
+async def get_prices_new(bz=str):
 
     date_today = date.today()
 
@@ -91,11 +60,12 @@ def get_prices_new(bz=str):
 
     code = bz_to_code(bz)
 
-    da_prices = fetch_entsoe_DA(start_str_date, end_str_date, code)
+    da_prices = await fetch_entsoe_DA(start_str_date, end_str_date, code)
 
     return da_prices
 
-def get_prices_pvpc(start_charge_timestamp, area=str):
+def pvpc_window(start_charge_timestamp):
+    # UTC half-open range of published PVPC hours usable by a session starting at start_charge_timestamp
 
     spain_tz = ZoneInfo("Europe/Madrid")
     utc = ZoneInfo("UTC")
@@ -125,59 +95,73 @@ def get_prices_pvpc(start_charge_timestamp, area=str):
     start_dt = start_dt.astimezone(utc)
     end_dt = end_dt.astimezone(utc)
 
-    pvpc_url = "https://api.esios.ree.es/indicators/1001"   
+    return start_dt, end_dt + timedelta(hours=1)
+
+
+async def get_pvpc_rows(start_charge_timestamp):
 
-    # params for request
-    params = {"start_date":start_dt,
-              "end_date":end_dt}
+    start_dt, end_dt = pvpc_window(start_charge_timestamp)
+    rows = await price_store.get_range(PVPC_SOURCE, PVPC_GEO_NAME, start_dt, end_dt, 3600, download_pvpc)
 
-    headers = {
-    "Accept": "application/json; application/vnd.esios-api-v1+json",
-    "Content-Type": "application/json",
-    "x-api-key": ESIOS_API_KEY,
-    }
+    return rows
 
-    response_pvpc = requests.get(pvpc_url, params=params, headers=headers)
-    content = response_pvpc.json()
-    pvpc_hour_values = [_dict['value'] for _dict in content['indicator']['values'] if _dict['geo_name']=='Península']
+
+async def get_prices_pvpc(start_charge_timestamp, area=str):
+
+    rows = await get_pvpc_rows(start_charge_timestamp)
+    pvpc_hour_values = [price for _, price in rows]
 
     return pvpc_hour_values
 
 
-def select_cheapest_hours(start_charge_timestamp, df, end_charge, soc):
+def pick_up_datetime(start_charge, hours, minutes):
+
+    end_charge = start_charge.replace(hour=hours, minute=minutes, second=0, microsecond=0)
+    if end_charge <= start_charge:
+        end_charge += timedelta(days=1)
+
+    return end_charge
+
+
+async def plan_charging(start_charge_timestamp, hours, minutes, soc, measured_power_w=None, device_id=None):
 
     spain_tz = ZoneInfo("Europe/Madrid")
     start_charge = datetime.fromisoformat(start_charge_timestamp.replace("Z", "+00:00")).astimezone(spain_tz)
+    end_charge = pick_up_datetime(start_charge, hours, minutes)
 
-    if end_charge<start_charge.hour:
-        hours = [i for i in range(start_charge.hour,24)]
-        hours.extend([i for i in range(end_charge)])
-    else:
-        hours = [i for i in range(start_charge.hour,end_charge)]
+    # the whole session is planned at once: hours whose prices are not published yet are planned on the
+    # price forecast, and the re-optimizer re-plans the session with the actual prices once they appear
+    timestamps, prices, _, _, forecasted = await forecast_slot_prices([provider_for(device_id)], start_charge, end_charge)
+    prices, forecasted = prices[0], forecasted[0]
+    if forecasted.any():
+        print(f"Planning {int(forecasted.sum())} unpublished quarter hours on forecast prices")
 
-    cutoff = start_charge.replace(hour=20, minute=30, second=0, microsecond=0)
+    power_kw = charger_power_kw(measured_power_w, CHARGER_POWER_KW)
+    n_slots = slots_needed(energy_needed_kwh(soc, BATTERY_CAPACITY_KWH), power_kw)
+    available = window_mask(timestamps, start_charge.timestamp(), end_charge.timestamp()) & ~np.isnan(prices)
+    selected = cheapest_slots(np.where(np.isnan(prices), np.inf, prices), n_slots, available, MIN_RUN_SLOTS)
 
-    if start_charge >= cutoff:
-        diff_to_referance_hour = start_charge.hour - 20 # in this case ref hour is 20:00
-    else:
-        diff_to_referance_hour = start_charge.hour # in this case ref hour is 00:00
+    intervals = [
+        (datetime.fromtimestamp(on, spain_tz), datetime.fromtimestamp(off, spain_tz))
+        for on, off in mask_to_intervals(timestamps, selected)
+    ]
 
-    print(df)
-    selected_hours = [(i,df[j]) for i,j in zip(hours,range(diff_to_referance_hour,diff_to_referance_hour+len(hours)))]
+    # n_slots is what the session needs, the intervals can hold fewer while part of the window is unpriced
+    return intervals, end_charge, n_slots
 
-    #selected_hours = [x for x in hourly_values if x[0] in hours]
 
-    #selected_hours = [(i,df[i]) for i in hours]
-    sorted_hours = sorted(selected_hours, key=lambda x: x[1])
+def charging_hours_from_intervals(intervals):
+    # local hours touched by the plan, as shown by the live consumption page
 
-    num_of_charge_hours_needed = round((1-soc/100)*4) # this can be interpolated if user inputs SoC of batt. Ex: assuming it takes 4 hours to cahrge from 0 to 100%, if charge is x then charge time is (1-x/100)*4
-    
-    final_hours = [x[0] for x in sorted_hours[:num_of_charge_hours_needed]]
-    
-    if start_charge in final_hours and datetime.now(spain_tz).minute > 20:
-        final_hours = [x[0] for x in sorted_hours[:num_of_charge_hours_needed+1]]
+    charging_hours = []
+    for on, off in intervals:
+        hour = on.replace(minute=0, second=0, microsecond=0)
+        while hour < off:
+            if hour.hour not in charging_hours:
+                charging_hours.append(hour.hour)
+            hour += timedelta(hours=1)
 
-    return final_hours
+    return charging_hours
 
 
 def seconds_until_next_hour():
@@ -190,17 +174,7 @@ def seconds_until_next_hour():
 
 
 def create_table():
-    CREATE_TABLE_SQL = """
-        CREATE TABLE IF NOT EXISTS power_readings (
-            timestamp TIMESTAMPTZ NOT NULL,
-            device_id TEXT NOT NULL,
-            power DOUBLE PRECISION NOT NULL
-        );
-    """
-    CREATE_INDEX_SQL = """
-        CREATE INDEX IF NOT EXISTS idx_power_device_ts
-        ON power_readings (timestamp DESC, device_id);
-    """
+    # schema and migrations, run once at startup from the lifespan (never on the request path)
     CREATE_SESSIONS_TABLE_SQL = '''
         CREATE TABLE IF NOT EXISTS sessions (
         start_charge_timestamp TIMESTAMPTZ NOT NULL,
@@ -216,66 +190,97 @@ def create_table():
 
     with pool.connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(CREATE_TABLE_SQL)
-            cur.execute(CREATE_INDEX_SQL)
+            ensure_partitioned(cur) # power_readings, partitioned by month
             cur.execute(CREATE_SESSIONS_TABLE_SQL)
             cur.execute(CREATE_SESSIONS_INDEX_SQL)
+            migrate_sessions(cur)
+            create_rollup_tables(cur)
+            backfill_rollups(cur)
+            create_prices_table(cur)
 
 
 async def charge(start_charge_timestamp, hours, minutes, soc, controller: MQTTClass):
 
-    pvpc_prices = get_prices_pvpc(start_charge_timestamp)
+    intervals, end_charge, n_slots = await plan_charging(start_charge_timestamp, hours, minutes, soc, controller.last_power, controller.device_id)
 
-    end_charge_hour = hours # to be inputted by user in 24h format
-    charging_hours = select_cheapest_hours(start_charge_timestamp, pvpc_prices, end_charge_hour, soc)
-
-    create_table() # creates postgresql table first time in case it is not created
-
-    await asyncio.to_thread(controller.run_charging_schedule, charging_hours, end_charge_hour)
+    session_id = await create_session(controller.device_id, start_charge_timestamp, hours, minutes, soc, intervals, end_charge, n_slots)
+    await scheduler.run_session(controller, intervals, end_charge, session_id, required_slots=n_slots)
 
     return controller
 
 
-def extract_power_readings(start_dt,end_dt):
+async def extract_power_readings(start_dt,end_dt,device_id=None):
 
+    # hourly energy (Wh) read from the rollup maintained at ingest, hours without readings count as 0
     EXTRACT_TOTAL_POWER_SQL = """
-        WITH time_buckets AS (
+        WITH hours AS (
             SELECT generate_series(
-                date_trunc('hour', %s::timestamp),
-                date_trunc('hour', %s::timestamp) - interval '120 seconds',
-                interval '120 seconds'
-            ) AS ts_120s
-        ),
-        bucketed_power AS (
-            SELECT
-                date_trunc('hour', tb.ts_120s) AS hour_ts,
-                tb.ts_120s,
-                AVG(pr.power) AS avg_power_120s
-            FROM time_buckets tb
-            LEFT JOIN power_readings pr
-                ON to_timestamp(
-                    floor(extract(epoch FROM pr.timestamp) / 120) * 120
-                ) = tb.ts_120s
-            GROUP BY hour_ts, tb.ts_120s
+                date_trunc('hour', %(start)s::timestamp),
+                date_trunc('hour', %(end)s::timestamp) - interval '1 hour',
+                interval '1 hour'
+            ) AS hour_ts
         )
         SELECT
-            hour_ts AS timestamp,
-            SUM(COALESCE(avg_power_120s, 0) * 120.0 / 3600.0) AS total_power
-        FROM bucketed_power
-        GROUP BY hour_ts
-        ORDER BY hour_ts;
+            h.hour_ts AS timestamp,
+            COALESCE(SUM(r.energy_wh), 0) AS total_power
+        FROM hours h
+        LEFT JOIN power_rollup_1h r
+            ON r.bucket = h.hour_ts
+            AND (%(device_id)s::text IS NULL OR r.device_id = %(device_id)s::text)
+        GROUP BY h.hour_ts
+        ORDER BY h.hour_ts;
 
     """
 
-    with pool.connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(EXTRACT_TOTAL_POWER_SQL, (start_dt, (datetime.strptime(end_dt, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')))
-            results = cur.fetchall()
+    async with async_pooled_connection(async_pool, "historic_power") as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(EXTRACT_TOTAL_POWER_SQL, {
+                "start": start_dt,
+                "end": (datetime.strptime(end_dt, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d'),
+                "device_id": device_id,
+            }, prepare=True)
+            results = await cur.fetchall()
 
     return results
 
     
-def historic_prices_pvpc(start_dt, end_dt):
+async def fetch_power_series(hours, device_id=None, until=None):
+    # raw readings of the last `hours` hours (before the epoch `until`, if given) as (epoch seconds, power) float arrays
+
+    async with async_pooled_connection(async_pool, "power_series") as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("""
+                SELECT
+                    extract(epoch FROM timestamp)::float8,
+                    power
+                FROM power_readings
+                WHERE timestamp > NOW() - (%(hours)s * INTERVAL '1 hour')
+                    AND (%(until)s::float8 IS NULL OR timestamp < to_timestamp(%(until)s::float8))
+                    AND (%(device_id)s::text IS NULL OR device_id = %(device_id)s::text)
+                ORDER BY timestamp ASC
+            """, {"hours": hours, "device_id": device_id, "until": until}, prepare=True)
+            rows = await cur.fetchall()
+
+    epochs = np.fromiter((row[0] for row in rows), dtype=np.float64, count=len(rows))
+    power = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+
+    return epochs, power
+
+
+async def recent_power_series(hours, device_id=None):
+    # the last `hours` hours from the in-memory buffers, only the part older than them is read from power_readings
+    since = time.time() - hours * 3600
+    covered_from, epochs, power = recent_readings.window(since, device_id)
+    if since >= covered_from:
+        POWER_SERIES_READS.inc("memory")
+        return epochs, power
+
+    POWER_SERIES_READS.inc("database")
+    older_epochs, older_power = await fetch_power_series(hours, device_id, until=covered_from)
+    return np.concatenate((older_epochs, epochs)), np.concatenate((older_power, power))
+
+
+async def historic_prices_pvpc(start_dt, end_dt):
 
     spain_tz = ZoneInfo("Europe/Madrid")
     utc = ZoneInfo("UTC")
@@ -286,30 +291,17 @@ def historic_prices_pvpc(start_dt, end_dt):
     start_dt = start_dt.astimezone(utc)
     end_dt = end_dt.astimezone(utc)
 
-    pvpc_url = "https://api.esios.ree.es/indicators/1001"   
-
-    # params for request
-    params = {"start_date":start_dt,
-              "end_date":end_dt}
-
-    headers = {
-    "Accept": "application/json; application/vnd.esios-api-v1+json",
-    "Content-Type": "application/json",
-    "x-api-key": "ea876fb64dfd6c269a411c66ccf3d13ebf07363e1090e0f26e62752e50d754ec",
-    }
-
-    response_pvpc = requests.get(pvpc_url, params=params, headers=headers)
-    content = response_pvpc.json()
-    pvpc_hour_values = [(_dict['datetime_utc'],_dict['value']) for _dict in content['indicator']['values'] if _dict['geo_name']=='Península']
+    rows = await price_store.get_range(PVPC_SOURCE, PVPC_GEO_NAME, start_dt, end_dt + timedelta(hours=1), 3600, download_pvpc)
+    pvpc_hour_values = [(dt.strftime("%Y-%m-%dT%H:%M:%SZ"), price) for dt, price in rows]
 
     return pvpc_hour_values
 
 
-def save_sessions_to_db(start_charge_timestamp, hours:int , minutes:int, soc:int):
+async def save_sessions_to_db(start_charge_timestamp, hours:int , minutes:int, soc:int):
 
-    with pool.connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(
+    async with async_pooled_connection(async_pool, "sessions") as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(
                 """
                 INSERT INTO sessions (start_charge_timestamp, pick_up_hour, pick_up_minute, soc)
                 VALUES (%s, %s, %s, %s)
@@ -317,20 +309,20 @@ def save_sessions_to_db(start_charge_timestamp, hours:int , minutes:int, soc:int
                 (start_charge_timestamp, hours, minutes, soc)
             )
     
-def select_latest_session_from_db(start_charge_timestamp, hours:int , minutes:int, soc:int):
+async def select_latest_session_from_db(start_charge_timestamp, hours:int , minutes:int, soc:int):
 
-    with pool.connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute( 
+    async with async_pooled_connection(async_pool, "sessions") as conn:
+        async with conn.cursor() as cur:
+            await cur.execute( 
                 """
-                SELECT *
+                SELECT start_charge_timestamp, pick_up_hour, pick_up_minute, soc
                 FROM sessions
                 ORDER BY start_charge_timestamp DESC
                 LIMIT 1;
                 """,
-                (start_charge_timestamp, hours, minutes, soc)
+                prepare=True
             )
-            results = cur.fetchall()
+            results = await cur.fetchall()
 
     return results
 
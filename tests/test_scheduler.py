@@ -0,0 +1,41 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from backend.scheduler import ChargingScheduler
+
+
+class FakeController():
+    def __init__(self, device_id:str="plug"):
+        self.device_id = device_id
+        self.switches = []
+
+    async def switch(self, state:bool):
+        self.switches.append(state)
+
+    def set_switch(self, state:bool):
+        self.switches.append(state)
+
+
+def run_plan(intervals, end_date):
+    async def main():
+        scheduler = ChargingScheduler(record_readings=False)
+        controller = FakeController()
+        done = scheduler.schedule(controller, intervals, end_date)
+        await asyncio.wait_for(done, 5)
+        return scheduler, controller
+    return asyncio.run(main())
+
+
+def test_plan_resumed_after_its_end_completes():
+    now = datetime.now(timezone.utc)
+    intervals = [(now - timedelta(hours=3), now - timedelta(hours=2))]
+    scheduler, controller = run_plan(intervals, now - timedelta(hours=1))
+    assert controller.switches == [False]
+    assert scheduler.plans == {}
+
+
+def test_plan_switches_on_and_completes():
+    now = datetime.now(timezone.utc)
+    intervals = [(now - timedelta(minutes=1), now + timedelta(seconds=0.2))]
+    scheduler, controller = run_plan(intervals, now + timedelta(seconds=0.4))
+    assert controller.switches == [True, False, False]
+    assert scheduler.plans == {}